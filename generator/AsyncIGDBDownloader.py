@@ -0,0 +1,171 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from HTTPCache import http_cache
+from IGDBDownloader import IGDBDownloader
+import asyncio
+import httpx
+import logging
+import os
+import time
+
+
+class TokenBucket():
+    """
+    Limits the requests started per second and the requests open at the same time
+    """
+
+    def __init__(self, rate, max_open):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+        self.open = asyncio.Semaphore(max_open)
+
+    async def __aenter__(self):
+        await self.open.acquire()
+        try:
+            async with self.lock:
+                while True:
+                    now = time.monotonic()
+                    self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return self
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        except BaseException:
+            self.open.release()
+            raise
+
+    async def __aexit__(self, *exc):
+        self.open.release()
+
+
+class AsyncIGDBDownloader(IGDBDownloader):
+    """
+    Same downloads as IGDBDownloader, but all platforms and multiquery batches are requested concurrently
+    """
+
+    # IGDB allows 4 requests per second and 8 open requests
+    RATE = 4
+    MAX_OPEN = 8
+
+    # A 429 is retried after Retry-After or BACKOFF * 2^attempt seconds
+    RETRIES = 5
+    BACKOFF = 1
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        # Created inside the event loop they are used in
+        self.bucket = TokenBucket(self.RATE, self.MAX_OPEN)
+
+        async with httpx.AsyncClient(timeout=60.0) as client:
+            self.client = client
+
+            self.headers = {'Client-ID': os.environ['TWITCH_CLIENT_ID'],
+                            'Authorization': f'Bearer {await self.get_token()}'}
+
+            await asyncio.gather(*[self.download_console(db[0], db[1]) for db in self.PLATFORMS])
+
+    async def get_token(self):
+        if http_cache.offline:
+            return ''
+
+        r = await self.client.post(self.TOKEN_URL, params=self.token_params())
+        r.raise_for_status()
+
+        return r.json()['access_token']
+
+    async def post(self, endpoint, data):
+        """
+        Runs a single IGDB query within the rate limits, retrying when IGDB still answers 429
+        """
+        for attempt in range(self.RETRIES + 1):
+            r = await http_cache.arequest(self.client, "POST", f"{self.API_URL}/{endpoint}",
+                                          headers=self.headers, content=data, limiter=self.bucket)
+
+            if r.status_code != 429 or attempt == self.RETRIES:
+                break
+
+            delay = self.retry_after(r.headers.get('Retry-After'), attempt)
+            logging.warning(f"IGDB rate limit reached, retrying {endpoint} in {delay}s")
+            await asyncio.sleep(delay)
+
+        r.raise_for_status()
+
+        return r.json()
+
+    def retry_after(self, value, attempt):
+        """
+        Seconds to wait from a Retry-After header, which is either a number of seconds or an HTTP date
+        """
+        if value is not None:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+        return self.BACKOFF * 2 ** attempt
+
+    async def multiquery(self, queries):
+        results = {}
+        for batch in await asyncio.gather(*[self.post("multiquery", batch) for batch in self.multiquery_batches(queries)]):
+            results.update(self.parse_multiquery(batch))
+
+        return results
+
+    async def query_all(self, queries):
+        results = {name: [] for name in queries}
+        pending = list(queries)
+        while len(pending) > 0:
+            pages = self.page_queries(queries, pending, results)
+            pending = self.add_pages(pages, await self.multiquery([page[2] for page in pages]), results)
+
+        return results
+
+    async def download_games(self, platform):
+        return (await self.query_all({"games": ("games", self.GAME_FIELDS, f"platforms = [{platform}]")}))["games"]
+
+    async def download_game_ids(self, platform):
+        ids = (await self.query_all({"ids": ("games", "id", f"platforms = [{platform}]")}))["ids"]
+        return {game['id'] for game in ids}
+
+    async def count_games(self, platform):
+        return (await self.post("games/count", f"where platforms = [{platform}];"))['count']
+
+    async def download_updated_games(self, platform, checkpoint):
+        updated = await self.query_all(self.updated_queries(platform, checkpoint))
+        games = {game['id']: game for game in updated["games"]}
+
+        ids, checkpoint = self.updated_date_games(games, updated["dates"], checkpoint)
+        for batch in (await self.query_all(self.game_queries(platform, ids))).values():
+            for game in batch:
+                games[game['id']] = game
+
+        return list(games.values()), checkpoint
+
+    async def download_console(self, platform, file_name):
+        checkpoint, stored = self.load_console(platform, file_name)
+
+        # Only saved along with the dump, a failed platform keeps its old checkpoint
+        if stored is None:
+            games, latest = await self.download_games(platform), 0
+        else:
+            games, latest = await self.download_updated_games(platform, checkpoint)
+
+        n_games, latest = self.substitute(platform, games, latest)
+
+        if stored is not None:
+            n_games = self.merge(platform, checkpoint, stored, n_games)
+
+            # Deleted games don't show up as updates, look for them only when the totals differ
+            if len(n_games) != await self.count_games(platform):
+                n_games = self.remove_deleted(n_games, await self.download_game_ids(platform))
+
+        self.save_console(platform, file_name, n_games, latest)
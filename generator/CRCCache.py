@@ -0,0 +1,62 @@
+from Metrics import metrics
+import hashlib
+import json
+import os
+
+
+class CRCCache():
+    """
+    On-disk cache of the MegaSD CRCs calculated by redumpFiller
+
+    Local ZIP files are keyed by path, size and modification time, remote ones by a hash
+    of the URL, Content-Length and ETag, so a changed file is never served an old CRC.
+    The URL itself is never stored, CI uploads the cache and the ROM source is secret.
+    Every new CRC is saved right away, an interrupted run resumes where it stopped
+    """
+
+    # Bump when cal_crc or the keys change to discard old CRCs
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.crcs = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.crcs = data['crcs']
+
+    @staticmethod
+    def file_key(path):
+        stat = os.stat(path)
+        return f"file {os.path.abspath(path)} {stat.st_size} {stat.st_mtime_ns}"
+
+    @staticmethod
+    def url_key(url, headers):
+        """
+        Key of a remote file from the headers of an uncached HEAD request
+        """
+        # Without an ETag, Last-Modified is the next best thing to tell versions apart
+        validator = headers.get('ETag') or headers.get('Last-Modified') or ''
+        return f"url {hashlib.sha256(url.encode()).hexdigest()} {headers.get('Content-Length')} {validator}"
+
+    def get(self, key):
+        if key in self.crcs:
+            metrics.count('crc_cache_hits')
+        return self.crcs.get(key)
+
+    def put(self, key, crc):
+        # Games that weren't found are tried again next time
+        if crc is None:
+            return
+
+        metrics.count('crcs_calculated')
+        self.crcs[key] = crc
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump({'version': self.VERSION, 'crcs': self.crcs}, f)
+        os.replace(f'{self.path}.tmp', self.path)
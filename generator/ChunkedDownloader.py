@@ -0,0 +1,120 @@
+from Metrics import metrics
+import asyncio
+import math
+import mmap
+import re
+
+
+class ChunkedDownloader():
+    """
+    Downloads a file with concurrent range requests straight into a preallocated file
+
+    The file is memory mapped and every range is written through its own slice of it,
+    so memory use doesn't grow with the file size. A failed range is resumed from its
+    last received byte. If the server ignores ranges the whole file is streamed instead
+    """
+
+    # Ranges of about this size, but never more than MAX_CHUNKS of them
+    CHUNK_SIZE = 8 * 1024 * 1024
+    MAX_CHUNKS = 40
+
+    # A failed range is resumed after BACKOFF * 2^attempt seconds
+    RETRIES = 5
+    BACKOFF = 1
+
+    def __init__(self, client, url, length, bandwidth=None):
+        self.client = client
+        self.url = url
+        self.length = length
+        self.bandwidth = bandwidth
+
+    def ranges(self):
+        """
+        Non-overlapping (start, end) ranges covering the file, end included
+        """
+        chunks = min(self.MAX_CHUNKS, max(1, math.ceil(self.length / self.CHUNK_SIZE)))
+        size = math.ceil(self.length / chunks)
+        return [(start, min(start + size, self.length) - 1) for start in range(0, self.length, size)]
+
+    async def download(self, f):
+        """
+        Download into the open binary file f, which is resized to the file length
+        """
+        if self.length == 0:
+            raise Exception(f"{self.url} is empty")
+
+        f.truncate(self.length)
+        with mmap.mmap(f.fileno(), self.length) as m:
+            with memoryview(m) as view:
+                ranges = self.ranges()
+
+                # The first range tells if the server supports them
+                if await self.fetch(view, *ranges[0]):
+                    tasks = [asyncio.ensure_future(self.fetch(view, start, end)) for start, end in ranges[1:]]
+                    try:
+                        await asyncio.gather(*tasks)
+                    except BaseException:
+                        # The other ranges hold slices of the view, which can't be released until they stop
+                        for task in tasks:
+                            task.cancel()
+                        await asyncio.gather(*tasks, return_exceptions=True)
+                        raise
+            m.flush()
+
+    async def fetch(self, view, start, end):
+        """
+        Download bytes start to end into view, resuming where a failed attempt stopped
+
+        Returns False if the server sent the whole file instead of the range
+        """
+        with view[start:end + 1] as chunk:
+            done = 0
+            for attempt in range(self.RETRIES + 1):
+                headers = {'Range': f'bytes={start + done}-{end}', 'Accept-Encoding': 'identity'}
+                try:
+                    metrics.count('http_requests')
+                    async with self.client.stream('GET', self.url, headers=headers, timeout=60.0,
+                                                  follow_redirects=True) as resp:
+                        resp.raise_for_status()
+
+                        if resp.status_code != 206:
+                            if start + done != 0:
+                                raise Exception(f"{self.url} stopped supporting range requests")
+                            # Not kept in done, a failed whole file download starts over
+                            received = 0
+                            async for received in self.stream(resp, view, 0):
+                                pass
+                            if received != len(view):
+                                raise Exception(f"{self.url} sent {received} of {len(view)} bytes")
+                            return False
+
+                        total = re.search(r'/(\d+)$', resp.headers.get('Content-Range', ''))
+                        if total is not None and int(total.group(1)) != self.length:
+                            raise Exception(f"{self.url} changed size to {total.group(1)} bytes")
+
+                        async for done in self.stream(resp, chunk, done):
+                            pass
+
+                    if done == len(chunk):
+                        return True
+                    raise Exception(f"range ended after {done} of {len(chunk)} bytes")
+                except Exception as e:
+                    if attempt == self.RETRIES:
+                        raise
+                    print(f'{start}-{end} failed at byte {start + done} ({e}), retrying')
+                    await asyncio.sleep(self.BACKOFF * 2 ** attempt)
+
+    async def stream(self, resp, view, offset):
+        """
+        Write a streamed response into view from offset, yielding the offset reached after every piece
+        """
+        async for data in resp.aiter_bytes():
+            if offset + len(data) > len(view):
+                raise Exception(f"{self.url} sent more bytes than expected")
+            view[offset:offset + len(data)] = data
+            offset += len(data)
+            metrics.count('http_bytes_downloaded', len(data))
+            yield offset
+
+            if self.bandwidth is not None:
+                await self.bandwidth.consume(len(data))
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+
+
+class CoverIndex():
+    """
+    Persistent index of the covers of a platform
+
+    Keeps every directory's subdirectories and PNG files with their size, modification
+    time, content hash and normalized key. Every directory is listed and its files are
+    stat'ed on each update, since overwriting a file doesn't change its directory's
+    modification time, but only new or changed files are hashed and normalized again.
+    Covers are walked in the same order as os.walk, sorted
+    """
+
+    # Bump when the index format changes to build it again
+    VERSION = 1
+
+    def __init__(self, cover_path, normalizer, path):
+        self.cover_path = cover_path
+        self.normalizer = normalizer
+        self.path = path
+        self.dirs = {}
+
+        # Directories listed and files hashed by the last update
+        self.listed = 0
+        self.hashed = 0
+
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION and data.get('cover_path') == cover_path:
+                self.dirs = data['dirs']
+
+                # Keys normalized by an older version are normalized again
+                if data.get('normalizer') != normalizer.VERSION:
+                    for entry in self.dirs.values():
+                        for name, cover in entry['files'].items():
+                            cover['key'] = normalizer.normalize(name)
+
+    def update(self):
+        dirs = {}
+        self.listed = 0
+        self.hashed = 0
+        if os.path.isdir(self.cover_path):
+            self.update_dir(self.cover_path, dirs)
+        self.dirs = dirs
+
+    def update_dir(self, directory, dirs):
+        old = self.dirs.get(directory)
+        entry = self.list_dir(directory, old['files'] if old is not None else {})
+        dirs[directory] = entry
+
+        for subdir in entry['dirs']:
+            self.update_dir(os.path.join(directory, subdir), dirs)
+
+    def list_dir(self, directory, old_files):
+        self.listed += 1
+        subdirs = []
+        files = {}
+
+        with os.scandir(directory) as entries:
+            for f in sorted(entries, key=lambda f: f.name):
+                if f.is_dir(follow_symlinks=False):
+                    subdirs.append(f.name)
+                elif f.name.endswith('.png') and not f.name.startswith('.'):
+                    stat = f.stat()
+                    cover = old_files.get(f.name)
+                    if cover is None or cover['size'] != stat.st_size or cover['mtime'] != stat.st_mtime_ns:
+                        self.hashed += 1
+                        with open(f.path, 'rb') as image:
+                            cover = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                     'hash': hashlib.sha256(image.read()).hexdigest(),
+                                     'key': self.normalizer.normalize(f.name)}
+                    files[f.name] = cover
+
+        return {'dirs': subdirs, 'files': files}
+
+    def covers(self):
+        """
+        Normalized key -> cover path, and the (key, cover, dropped cover, same image) collisions
+
+        The last cover of a key wins, but the key keeps the position of the first one
+        """
+        covers = {}
+        hashes = {}
+        collisions = []
+
+        for directory, entry in self.dirs.items():
+            for name, cover in entry['files'].items():
+                path = os.path.join(directory, name)
+                if cover['key'] in covers:
+                    collisions.append((cover['key'], path, covers[cover['key']], hashes[cover['key']] == cover['hash']))
+                covers[cover['key']] = path
+                hashes[cover['key']] = cover['hash']
+
+        return covers, collisions
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump({'version': self.VERSION, 'cover_path': self.cover_path,
+                       'normalizer': self.normalizer.VERSION, 'dirs': self.dirs}, f)
+        os.replace(f'{self.path}.tmp', self.path)
@@ -0,0 +1,155 @@
+from concurrent.futures import ProcessPoolExecutor
+from XMLBuilder import XMLGenerator
+import hashlib
+import json
+import logging
+import os
+
+
+def process_cover(src, dst, known_hash):
+    """
+    Resize and quantize a source PNG into dst, unless its content hash is known_hash and dst exists
+
+    Returns the content hash and whether dst was written
+    """
+    with open(src, 'rb') as f:
+        data = f.read()
+    content_hash = hashlib.sha256(data).hexdigest()
+
+    if content_hash == known_hash and os.path.exists(dst):
+        return content_hash, False
+
+    # Only this stage needs Pillow
+    try:
+        from PIL import Image
+    except ImportError:
+        raise Exception("--process-covers needs Pillow, install the dependencies with `pipenv install`")
+
+    with Image.open(src) as image:
+        image = image.convert('RGBA')
+
+        # Transparent parts are shown over the black menu background
+        background = Image.new('RGBA', image.size, (0, 0, 0, 255))
+        image = Image.alpha_composite(background, image).convert('RGB')
+
+        image = image.resize(CoverProcessor.SIZE, Image.LANCZOS)
+        image = image.quantize(colors=CoverProcessor.COLORS, dither=Image.NONE)
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        image.save(f'{dst}.tmp', 'PNG', optimize=True)
+    os.replace(f'{dst}.tmp', dst)
+
+    return content_hash, True
+
+
+class CoverProcessor():
+    """
+    Converts libretro-thumbnails covers to the MegaSD format
+
+    SRC/<libretro system>/Named_Titles is converted into output/<system>/Named_Titles, the
+    folders XMLGenerator reads the covers from. A manifest keeps the size, modification time
+    and content hash of every source image, so only new or changed images are converted again
+    """
+
+    # libretro-thumbnails system folder of every output folder. Clones of a single
+    # system's repository use underscores instead of spaces, both are looked for
+    LIBRETRO_FOLDERS = {
+        'Sega - Mega Drive - Genesis': 'Sega - Mega Drive - Genesis',
+        'Sega - Master System - Mark III': 'Sega - Master System - Mark III',
+        'Sega - 32X': 'Sega - 32X',
+        'Sega - SG-1000': 'Sega - SG-1000',
+        'Sega - Mega CD & Sega CD': 'Sega - Mega-CD - Sega CD',
+    }
+
+    # MegaSD menu covers are 64x40 with a 16 color palette
+    SIZE = (64, 40)
+    COLORS = 16
+
+    # Bump when the conversion changes to convert every cover again
+    VERSION = 1
+
+    def __init__(self, source, manifest='cache/covers.json'):
+        logging.info(f"Processing covers from {source}")
+
+        self.manifest_path = manifest
+        self.manifest = self.load_manifest()
+
+        jobs = self.find_covers(source)
+
+        # Unchanged size and modification time, no need to even hash them
+        pending = []
+        for src, dst, key, stat in jobs:
+            entry = self.manifest.get(key)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns \
+                    or not os.path.exists(dst):
+                pending.append((src, dst, key, stat))
+
+        processed = 0
+        with ProcessPoolExecutor() as executor:
+            hashes = executor.map(process_cover, [src for src, dst, key, stat in pending],
+                                  [dst for src, dst, key, stat in pending],
+                                  [self.manifest.get(key, {}).get('hash') for src, dst, key, stat in pending],
+                                  chunksize=8)
+
+            for (src, dst, key, stat), (content_hash, written) in zip(pending, hashes):
+                self.manifest[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': content_hash}
+                processed += written
+
+        self.save_manifest()
+
+        logging.info(f"Covers: {len(jobs)}")
+        logging.info(f"Checked: {len(pending)}")
+        logging.info(f"Processed: {processed}\n")
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                return data['covers']
+        return {}
+
+    def save_manifest(self):
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        with open(f'{self.manifest_path}.tmp', 'w') as f:
+            json.dump({'version': self.VERSION, 'covers': self.manifest}, f)
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+
+    @classmethod
+    def source_folder(cls, source, cover_path):
+        """
+        output/<system>/Named_Titles -> SRC/<libretro system>/Named_Titles, None if it doesn't exist
+        """
+        system, titles = os.path.split(os.path.relpath(cover_path, 'output'))
+        libretro = cls.LIBRETRO_FOLDERS[system]
+        for folder in [libretro, libretro.replace(' ', '_')]:
+            if os.path.isdir(os.path.join(source, folder, titles)):
+                return os.path.join(source, folder, titles)
+        return None
+
+    @classmethod
+    def find_covers(cls, source):
+        """
+        (source image, output image, manifest key, source stat) for the PNGs of every platform
+        """
+        jobs = []
+        for platform in XMLGenerator.PLATFORMS:
+            cover_path = platform[2]
+            source_path = cls.source_folder(source, cover_path)
+            if source_path is None:
+                logging.warning(f"No {cls.LIBRETRO_FOLDERS[os.path.basename(os.path.dirname(cover_path))]} "
+                                f"covers in {source}")
+                continue
+
+            for root, dirs, files in os.walk(source_path):
+                dirs.sort()
+                for f in sorted(files):
+                    if not f.lower().endswith('.png'):
+                        continue
+
+                    src = os.path.join(root, f)
+                    relative = os.path.relpath(src, source_path)
+                    dst = os.path.join(cover_path, relative)
+                    jobs.append((src, dst, os.path.join(os.path.relpath(cover_path, 'output'), relative),
+                                 os.stat(src)))
+        return jobs
@@ -0,0 +1,113 @@
+from collections import defaultdict
+from GameDB import NS
+from lxml import etree
+from ReleaseZip import ReleaseZip
+from zipfile import ZipFile
+import json
+import logging
+
+
+class DeltaPackage():
+    """
+    Update package from a previous release ZIP file to a newer one
+
+    Holds the added or changed members of the new release, db.xml included, every member
+    of the new release in order in members.txt, the paths of the removed members in
+    removed.txt, and db_delta.json with the Game records that were added, changed or
+    removed and the checksums that were added or removed. apply rebuilds the new release,
+    byte for byte, from the previous one and the package
+
+    Game IDs are renumbered whenever a game is added or removed before them, so games are
+    matched by their sorted checksums instead, or by name if they have none. Every Game in
+    db_delta.json lists its checksums, which says which game a new checksum belongs to
+    """
+
+    def __init__(self, previous, current, path, date_time):
+        with ZipFile(previous) as old, ZipFile(current) as new:
+            old_infos = {info.filename: info for info in old.infolist()}
+            new_infos = {info.filename: info for info in new.infolist()}
+
+            release = ReleaseZip(path, date_time)
+            changed = 0
+            for name, info in new_infos.items():
+                old_info = old_infos.get(name)
+                if old_info is None or old_info.CRC != info.CRC or old_info.file_size != info.file_size:
+                    release.add_bytes(name, new.read(name))
+                    changed += 1
+
+            release.add_bytes('members.txt', ''.join(f'{name}\n' for name in new_infos).encode())
+
+            removed = [name for name in old_infos if name not in new_infos]
+            release.add_bytes('removed.txt', ''.join(f'{name}\n' for name in removed).encode())
+
+            delta = self.diff(self.records(old), self.records(new))
+            release.add_bytes('db_delta.json', json.dumps(delta, ensure_ascii=False, separators=(',', ':')).encode())
+
+        release.build()
+
+        logging.info(f"Delta package: {path}")
+        logging.info(f"Added or changed members: {changed}")
+        logging.info(f"Removed members: {len(removed)}")
+        logging.info(f"Games added/changed/removed: {len(delta['games']['added'])}/"
+                     f"{len(delta['games']['changed'])}/{len(delta['games']['removed'])}")
+        logging.info(f"Checksums added/removed: {len(delta['checksums']['added'])}/"
+                     f"{len(delta['checksums']['removed'])}\n")
+
+    @staticmethod
+    def apply(previous, delta, path):
+        """
+        Rebuild the new release from the previous release ZIP file and a delta package
+        """
+        with ZipFile(previous) as old, ZipFile(delta) as package:
+            infos = {info.filename: info for info in package.infolist()}
+            members = package.read('members.txt').decode().splitlines()
+
+            # Every member of a release has the same timestamp
+            release = ReleaseZip(path, infos['members.txt'].date_time, previous)
+            for name in members:
+                release.add_bytes(name, (package if name in infos else old).read(name))
+
+        release.build()
+
+    @staticmethod
+    def records(zipObj):
+        """
+        Game key -> Game fields with their checksums, from the db.xml of a release
+        """
+        games = {}
+        checksums = defaultdict(list)
+
+        with zipObj.open('db.xml') as f:
+            for _, element in etree.iterparse(f, tag=[f'{{{NS}}}Game', f'{{{NS}}}GameCk']):
+                fields = {etree.QName(child).localname: child.text for child in element}
+                if etree.QName(element).localname == 'Game':
+                    games[fields['ID']] = fields
+                else:
+                    checksums[fields['GameID']].append(fields['Checksum'])
+                element.clear()
+
+        records = {}
+        for id, game in games.items():
+            game['Checksums'] = sorted(checksums[id])
+            records[' '.join(game['Checksums']) or f"name {game['Name']}"] = game
+        return records
+
+    @staticmethod
+    def diff(old, new):
+        def content(game):
+            return {field: text for field, text in game.items() if field != 'ID'}
+
+        old_checksums = {crc for game in old.values() for crc in game['Checksums']}
+        new_checksums = {crc for game in new.values() for crc in game['Checksums']}
+
+        return {
+            'games': {
+                'added': [game for key, game in new.items() if key not in old],
+                'changed': [game for key, game in new.items() if key in old and content(old[key]) != content(game)],
+                'removed': [game['ID'] for key, game in old.items() if key not in new],
+            },
+            'checksums': {
+                'added': sorted(new_checksums - old_checksums),
+                'removed': sorted(old_checksums - new_checksums),
+            },
+        }
@@ -0,0 +1,242 @@
+from collections import Counter, defaultdict
+from fuzzywuzzy import fuzz, process, utils
+from rapidfuzz import fuzz as rapid_fuzz
+from rapidfuzz.process import cdist
+import logging
+import math
+import numpy
+
+
+class FuzzyMatcher():
+    """
+    Candidate index built once per set of choices
+
+    extract_one returns the same (choice, score) pair as fuzzywuzzy's
+    process.extractOne with the default WRatio scorer, but only scores the
+    candidates whose upper bound can still beat the best match found so far.
+    extract_many does the same for a whole list of queries from a rapidfuzz
+    score matrix computed on all cores
+    """
+
+    # Size of the n-grams used for blocking
+    Q = 2
+
+    # Queries scored per rapidfuzz call in batch mode, caps the score matrix memory
+    BATCH_SIZE = 1024
+
+    def __init__(self, choices, check_parity=False):
+        self.choices = list(choices)
+        self.check_parity = check_parity
+        self.mismatches = 0
+        self.comparisons = 0
+
+        # Results of extract_one, precomputed by extract_many or restored from a cache
+        self.matches = {}
+
+        # The index is only built once a query has to be scored, queries restored
+        # from a cache don't need it
+        self.processed = None
+
+    def build_index(self):
+        if self.processed is not None:
+            return
+
+        # Same processing extractOne applies to every choice
+        self.processed = [utils.full_process(c, force_ascii=True) for c in self.choices]
+
+        # Processed form -> index of its first choice
+        self.exact = {}
+        # N-gram -> [(choice index, occurrences)]
+        self.grams = defaultdict(list)
+        # Length -> choice indexes, only for single token choices
+        self.lengths = defaultdict(list)
+        # Multi token choices can score high through the token set ratio, always score them
+        self.multi_token = []
+
+        for i, p in enumerate(self.processed):
+            self.exact.setdefault(p, i)
+
+            if ' ' in p:
+                self.multi_token.append(i)
+                continue
+
+            self.lengths[len(p)].append(i)
+            for gram, n in self.ngrams(p).items():
+                self.grams[gram].append((i, n))
+
+    @classmethod
+    def ngrams(cls, s):
+        return Counter(s[i:i + cls.Q] for i in range(len(s) - cls.Q + 1))
+
+    @classmethod
+    def bound(cls, la, lb, shared):
+        """
+        Upper bound of WRatio for two single token strings with lengths la and lb
+        that have `shared` n-grams in common
+        """
+        if la == 0 or lb == 0:
+            return 0
+
+        short, long = min(la, lb), max(la, lb)
+
+        # Every insertion or deletion destroys at most Q n-grams
+        distance = max(long - short, math.ceil((long - cls.Q + 1 - shared) / cls.Q))
+        base = 100 * (1 - distance / (la + lb))
+
+        # Same length ratio checks WRatio does
+        len_ratio = float(long) / short
+        if len_ratio < 1.5:
+            return math.ceil(base + 1e-9)
+
+        partial_scale = .6 if len_ratio > 8 else .9
+
+        # Best window of the longer string has the same length as the shorter one
+        distance = max(0, math.ceil((short - cls.Q + 1 - shared) / cls.Q))
+        partial = math.ceil(100 * (1 - distance / (2 * short)) + 1e-9)
+
+        return math.ceil(max(base, partial * partial_scale) + 1e-9)
+
+    def score(self, query, i):
+        self.comparisons += 1
+        return fuzz.WRatio(query, self.processed[i], force_ascii=True, full_process=False)
+
+    def shortcut(self, query):
+        """
+        Best match of a processed query when it is known without scoring anything
+        """
+        # Every score is 0, extractOne keeps the first choice
+        if len(query) == 0:
+            return (self.choices[0], 0)
+
+        # Up to this length only identical strings can round up to 100
+        if len(query) <= 80 and query in self.exact:
+            return (self.choices[self.exact[query]], 100)
+
+        return None
+
+    def search(self, query):
+        if len(self.choices) == 0:
+            return None
+
+        self.build_index()
+        query = utils.full_process(query, force_ascii=True)
+
+        match = self.shortcut(query)
+        if match is not None:
+            return match
+
+        # Token based ratios are not covered by the bounds, fall back to a linear scan
+        if ' ' in query:
+            best_score, best = -1, None
+            for i in range(len(self.choices)):
+                s = self.score(query, i)
+                if s > best_score:
+                    best_score, best = s, i
+            return (self.choices[best], best_score)
+
+        # extractOne keeps the first choice with the highest score
+        best_score, best = -1, None
+
+        def update(i):
+            nonlocal best_score, best
+            s = self.score(query, i)
+            if s > best_score or (s == best_score and i < best):
+                best_score, best = s, i
+
+        def beats(bound, i):
+            return bound > best_score or (bound == best_score and i < best)
+
+        for i in self.multi_token:
+            update(i)
+
+        # Count n-grams shared with every candidate
+        shared = defaultdict(int)
+        for gram, n in self.ngrams(query).items():
+            for i, m in self.grams.get(gram, ()):
+                shared[i] += min(n, m)
+
+        la = len(query)
+        candidates = sorted((-self.bound(la, len(self.processed[i]), n), i) for i, n in shared.items())
+        for bound, i in candidates:
+            if not beats(-bound, i):
+                break
+            update(i)
+
+        # Candidates with no n-grams in common, pruned by length bucket
+        for lb, indexes in self.lengths.items():
+            bound = self.bound(la, lb, 0)
+            if not beats(bound, indexes[0]):
+                continue
+            for i in indexes:
+                if i not in shared and beats(bound, i):
+                    update(i)
+
+        return (self.choices[best], best_score)
+
+    def rescore(self, query, scores, lengths):
+        """
+        Best match of a processed query from its row of rapidfuzz scores
+        """
+        match = self.shortcut(query)
+        if match is not None:
+            return match
+
+        # rapidfuzz finds the optimal partial alignment and does not round the
+        # intermediate ratios, so it never scores more than 1 point below fuzzywuzzy.
+        # The exception is a length ratio of exactly 8, where it already uses the 0.6 scale
+        bounds = scores + 1.001
+        eight = numpy.maximum(lengths, len(query)) == 8 * numpy.minimum(lengths, len(query))
+        bounds[eight] = scores[eight] * 1.5 + 1.001
+        bounds = numpy.floor(bounds)
+
+        # Rescore with fuzzywuzzy while a candidate can still beat the best match
+        best_score, best = -1, None
+        for i in numpy.argsort(-bounds, kind='stable').tolist():
+            if bounds[i] < best_score or (bounds[i] == best_score and i > best):
+                break
+            s = self.score(query, i)
+            if s > best_score or (s == best_score and i < best):
+                best_score, best = s, i
+
+        return (self.choices[best], best_score)
+
+    def extract_many(self, queries):
+        """
+        Score every query against every choice in one vectorized rapidfuzz call
+        and keep the best matches for extract_one
+        """
+        queries = [q for q in dict.fromkeys(queries) if q not in self.matches]
+        if not queries:
+            return
+
+        if len(self.choices) == 0:
+            self.matches.update(dict.fromkeys(queries))
+            return
+
+        self.build_index()
+        processed = [utils.full_process(q, force_ascii=True) for q in queries]
+        lengths = numpy.array([len(p) for p in self.processed])
+
+        for start in range(0, len(queries), self.BATCH_SIZE):
+            batch = processed[start:start + self.BATCH_SIZE]
+            scores = cdist(batch, self.processed, scorer=rapid_fuzz.WRatio, processor=None, workers=-1)
+            self.comparisons += scores.size
+
+            for query, p, row in zip(queries[start:start + self.BATCH_SIZE], batch, scores):
+                self.matches[query] = self.rescore(p, row, lengths)
+
+    def extract_one(self, query):
+        if query in self.matches:
+            match = self.matches[query]
+        else:
+            match = self.search(query)
+
+        if self.check_parity:
+            expected = process.extractOne(query, self.choices)
+            if match != expected:
+                self.mismatches += 1
+                logging.error(f"Match mismatch for {query}: {match} != {expected} (linear)")
+                match = expected
+
+        self.matches[query] = match
+        return match
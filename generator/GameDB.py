@@ -0,0 +1,2 @@
+# Namespace of the GameDB schema in game.xsd, used to write and to read db.xml
+NS = 'http://tempuri.org/GameDB.xsd'
@@ -0,0 +1,254 @@
+from Metrics import metrics
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlsplit
+import hashlib
+import httpx
+import json
+import os
+import requests
+import time
+
+
+class HTTPCache():
+    """
+    On-disk cache of HTTP responses shared by all the downloaders
+
+    Responses are keyed by method, URL, body and Range header. A response is served from disk
+    while it is younger than its source's TTL, after that it is revalidated with its
+    ETag/Last-Modified and only downloaded again if it changed. In offline mode every
+    request is served from disk, however old
+
+    Only a hash of the URL is stored, the cache folder is uploaded by CI and URLs can be secret.
+    ROM downloads don't go through it, a ROM can be replaced under the same URL. Entries older
+    than their TTL that a run didn't use are pruned at its end, so requests that are never
+    repeated, like IGDB updates since an old checkpoint, don't pile up
+    """
+
+    # Seconds a response is used without asking the server, by host
+    TTLS = {
+        'api.igdb.com': 12 * 3600,
+        'github.com': 3600,
+        'raw.githubusercontent.com': 3600,
+        'redump.org': 24 * 3600,
+    }
+
+    # Any other host
+    DEFAULT_TTL = 7 * 24 * 3600
+
+    # Stored response headers that don't apply to the decoded body
+    DROPPED_HEADERS = ['content-encoding', 'transfer-encoding']
+
+    def __init__(self, path, offline=False):
+        self.path = path
+        self.offline = offline
+
+        # Keys looked up by this run, never pruned
+        self.used = set()
+
+    @staticmethod
+    def key(method, url, body, range_header):
+        if isinstance(body, str):
+            body = body.encode()
+
+        h = hashlib.sha256()
+        for part in [method.encode(), url.encode(), body or b'', (range_header or '').encode()]:
+            h.update(part)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def ttl(self, url):
+        return self.TTLS.get(urlsplit(url).hostname, self.DEFAULT_TTL)
+
+    def load(self, key):
+        try:
+            with open(f'{self.path}/{key}.json') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if not os.path.exists(self.body_path(key)):
+            return None
+        return entry
+
+    def body_path(self, key):
+        return f'{self.path}/{key}.body'
+
+    def read_body(self, key):
+        with open(self.body_path(key), 'rb') as f:
+            return f.read()
+
+    def store(self, key, method, url, status_code, headers, body):
+        os.makedirs(self.path, exist_ok=True)
+        with open(f'{self.body_path(key)}.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(f'{self.body_path(key)}.tmp', self.body_path(key))
+
+        return self.store_entry(key, method, url, status_code, headers, len(body))
+
+    def store_entry(self, key, method, url, status_code, headers, length):
+        headers = {k: v for k, v in headers.items() if k.lower() not in self.DROPPED_HEADERS}
+        if method != 'HEAD':
+            headers = {k: v for k, v in headers.items() if k.lower() != 'content-length'}
+            headers['Content-Length'] = str(length)
+
+        entry = {'url_sha256': hashlib.sha256(url.encode()).hexdigest(), 'status_code': status_code, 'headers': headers,
+                 'time': time.time(), 'ttl': self.ttl(url)}
+        self.save(key, entry)
+
+        return entry
+
+    def save(self, key, entry):
+        with open(f'{self.path}/{key}.json.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(f'{self.path}/{key}.json.tmp', f'{self.path}/{key}.json')
+
+    def lookup(self, method, url, body, headers):
+        """
+        Returns the key, the cached entry, and whether it can be used without the network
+        """
+        key = self.key(method, url, body, headers.get('Range'))
+        self.used.add(key)
+        entry = self.load(key)
+
+        if entry is None:
+            if self.offline:
+                raise Exception(f"{method} {url} is not in the HTTP cache")
+            return key, None, False
+
+        if self.offline or time.time() - entry['time'] < self.ttl(url):
+            metrics.count('http_cache_hits')
+            return key, entry, True
+
+        # Stale, ask the server if it changed
+        for validator, header in [('ETag', 'If-None-Match'), ('Last-Modified', 'If-Modified-Since')]:
+            value = CaseInsensitiveDict(entry['headers']).get(validator)
+            if value is not None:
+                headers[header] = value
+
+        return key, entry, False
+
+    def update(self, key, entry, method, url, status_code, headers, body):
+        """
+        Stores a response from the network, returns the cached entry to answer with if it was not modified
+        """
+        metrics.count('http_requests')
+        metrics.count('http_bytes_downloaded', len(body))
+
+        if status_code == 304 and entry is not None:
+            metrics.count('http_not_modified')
+            entry['time'] = time.time()
+            self.save(key, entry)
+            return entry
+
+        if status_code in (200, 206):
+            self.store(key, method, url, status_code, headers, body)
+
+        return None
+
+    def request(self, method, url, headers=None, params=None, data=None):
+        """
+        Same as requests.request
+        """
+        prepared = requests.Request(method, url, headers=headers, params=params, data=data).prepare()
+        key, entry, fresh = self.lookup(prepared.method, prepared.url, prepared.body, prepared.headers)
+
+        if not fresh:
+            with requests.Session() as session:
+                r = session.send(prepared, allow_redirects=method != 'HEAD')
+            if self.update(key, entry, prepared.method, prepared.url, r.status_code, r.headers, r.content) is None:
+                return r
+
+        r = requests.Response()
+        r.status_code = entry['status_code']
+        r.reason = 'OK'
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.url = prepared.url
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r._content = self.read_body(key)
+        return r
+
+    async def arequest(self, client, method, url, headers=None, params=None, content=None,
+                       timeout=httpx.USE_CLIENT_DEFAULT, limiter=None):
+        """
+        Same as httpx.AsyncClient.request following redirects, `limiter` is entered only to use the network
+        """
+        request = client.build_request(method, url, headers=headers, params=params, content=content, timeout=timeout)
+        key, entry, fresh = self.lookup(request.method, str(request.url), request.content, request.headers)
+
+        if not fresh:
+            if limiter is None:
+                r = await client.send(request, follow_redirects=True)
+            else:
+                async with limiter:
+                    r = await client.send(request, follow_redirects=True)
+            if self.update(key, entry, request.method, str(request.url), r.status_code, r.headers, r.content) is None:
+                return r
+
+        return httpx.Response(entry['status_code'], headers=entry['headers'], content=self.read_body(key), request=request)
+
+    def download(self, url):
+        """
+        GET streamed straight into the cache, for downloads too big to hold in memory
+
+        Returns the cached entry, the path of its body, and whether it was downloaded again
+        """
+        prepared = requests.Request('GET', url).prepare()
+        key, entry, fresh = self.lookup(prepared.method, prepared.url, prepared.body, prepared.headers)
+        if fresh:
+            return entry, self.body_path(key), False
+
+        with requests.Session() as session:
+            with session.send(prepared, stream=True) as r:
+                if r.status_code == 304 and entry is not None:
+                    # update counts the request
+                    return self.update(key, entry, 'GET', prepared.url, 304, r.headers, b''), self.body_path(key), False
+                r.raise_for_status()
+
+                os.makedirs(self.path, exist_ok=True)
+                length = 0
+                with open(f'{self.body_path(key)}.tmp', 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        f.write(chunk)
+                        length += len(chunk)
+                os.replace(f'{self.body_path(key)}.tmp', self.body_path(key))
+                metrics.count('http_requests')
+                metrics.count('http_bytes_downloaded', length)
+
+                return self.store_entry(key, 'GET', prepared.url, r.status_code, r.headers, length), self.body_path(key), True
+
+    def prune(self):
+        """
+        Delete the entries older than their TTL that weren't used by this run, and leftover bodies
+        """
+        if self.offline or not os.path.isdir(self.path):
+            return
+
+        now = time.time()
+        pruned = 0
+        for name in os.listdir(self.path):
+            key, ext = os.path.splitext(name)
+            if key in self.used or ext not in ('.json', '.body'):
+                continue
+
+            if ext == '.json':
+                try:
+                    with open(f'{self.path}/{name}') as f:
+                        entry = json.load(f)
+                except ValueError:
+                    entry = None
+                if entry is not None and now - entry['time'] < entry.get('ttl', self.DEFAULT_TTL):
+                    continue
+                pruned += 1
+            elif os.path.exists(f'{self.path}/{key}.json'):
+                continue
+
+            # The body of a pruned entry may have been listed already
+            for path in [f'{self.path}/{key}.json', self.body_path(key)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        metrics.count('http_cache_pruned', pruned)
+
+
+# Shared by every downloader, --offline switches it to offline mode
+http_cache = HTTPCache('cache/http')
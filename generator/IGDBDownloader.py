@@ -1,3 +1,7 @@
+from HTTPCache import http_cache
+from IGDBStore import IGDBStore
+from Metrics import metrics
+from Normalizer import Normalizer
 import requests
 import logging
 import json
@@ -5,12 +9,27 @@ import os
 
 
 class IGDBDownloader():
-    def __init__(self):
+    # (IGDB platform ID, dump file name)
+    PLATFORMS = [(29, 'genesis.json'), (64, 'ms.json'), (78, 'cd.json'), (30, '32x.json'), (84, 'sg1000.json')]
+
+    # Newest updated_at already merged into each dump
+    CHECKPOINTS = 'dbs/checkpoints.json'
+
+    # Can be pointed to a local server
+    API_URL = "https://api.igdb.com/v4"
+    TOKEN_URL = "https://id.twitch.tv/oauth2/token"
+
+    # Most results IGDB returns per query
+    LIMIT = 500
+
+    # Most queries IGDB runs per multiquery request
+    MULTIQUERY_LIMIT = 10
+
+    def __init__(self, full_refresh=False):
         logging.info("Downloading info from IGDB\n")
 
-        self.headers = {'Client-ID': os.environ['TWITCH_CLIENT_ID'], 'Authorization': f'Bearer {self.get_token()}'}
+        self.full_refresh = full_refresh
 
-        self.genres = self.download_genres()
         self.regions = {
             1: "europe",
             2: "north_america",
@@ -22,146 +41,295 @@ class IGDBDownloader():
             8: "worldwide"
         }
 
-        for db in [(29, 'genesis.json'), (64, 'ms.json'), (78, 'cd.json'), (30, '32x.json'), (84, 'sg1000.json')]:
-            self.download_console(db[0], db[1])
+        # Written next to the JSON dumps, with the names already normalized for XMLGenerator
+        self.store = IGDBStore()
+        self.normalizer = Normalizer()
+
+        self.checkpoints = {}
+        if not full_refresh and os.path.exists(self.CHECKPOINTS):
+            with open(self.CHECKPOINTS) as f:
+                self.checkpoints = json.load(f)
+
+        try:
+            self.run()
+        finally:
+            self.store.close()
 
-        if len(os.listdir("./dbs")) != 5:
-            raise Exception("Expected 5 JSONs in ./dbs folder")
+        for db in self.PLATFORMS:
+            if not os.path.exists(f'dbs/{db[1]}'):
+                raise Exception(f"Expected {db[1]} in ./dbs folder")
+
+    def run(self):
+        self.headers = {'Client-ID': os.environ['TWITCH_CLIENT_ID'], 'Authorization': f'Bearer {self.get_token()}'}
+
+        for db in self.PLATFORMS:
+            self.download_console(db[0], db[1])
 
     def get_token(self):
-        r = requests.request("POST", "https://id.twitch.tv/oauth2/token", params={
+        # Cached responses don't need a token, and it isn't stored on disk
+        if http_cache.offline:
+            return ''
+
+        r = requests.request("POST", self.TOKEN_URL, params=self.token_params())
+        r.raise_for_status()
+
+        return r.json()['access_token']
+
+    @staticmethod
+    def token_params():
+        return {
             'client_id': os.environ['TWITCH_CLIENT_ID'],
             'client_secret': os.environ['TWITCH_CLIENT_SECRET'],
             'grant_type': 'client_credentials'
-        })
+        }
+
+    def post(self, endpoint, data):
+        """
+        Runs a single IGDB request
+        """
+        r = http_cache.request("POST", f"{self.API_URL}/{endpoint}", headers=self.headers, data=data)
         r.raise_for_status()
 
-        return r.json()['access_token']
+        return r.json()
 
-    def download_genres(self):
+    def multiquery(self, queries):
         """
-        Downloads all IGDB genres
+        Runs (endpoint, name, query) tuples MULTIQUERY_LIMIT at a time, returns the results by name
         """
+        results = {}
+        for batch in self.multiquery_batches(queries):
+            results.update(self.parse_multiquery(self.post("multiquery", batch)))
 
-        r = requests.request("POST", "https://api.igdb.com/v4/genres",
-                             headers=self.headers,
-                             data="fields id,name; limit 500; sort id;")
-        r.raise_for_status()
+        return results
+
+    @classmethod
+    def multiquery_batches(cls, queries):
+        return [''.join(f'query {endpoint} "{name}" {{ {query} }};' for endpoint, name, query in queries[i:i + cls.MULTIQUERY_LIMIT])
+                for i in range(0, len(queries), cls.MULTIQUERY_LIMIT)]
+
+    @staticmethod
+    def parse_multiquery(resp_json):
+        return {result['name']: result['count'] if 'count' in result else result['result'] for result in resp_json}
+
+    def query_all(self, queries):
+        """
+        Runs several {name: (endpoint, fields, where)} queries until every page of each is returned,
+        as many pages as a multiquery request allows at a time
+        """
+        results = {name: [] for name in queries}
+        pending = list(queries)
+        while len(pending) > 0:
+            pages = self.page_queries(queries, pending, results)
+            pending = self.add_pages(pages, self.multiquery([page[2] for page in pages]), results)
+
+        return results
+
+    @classmethod
+    def page_queries(cls, queries, pending, results):
+        """
+        Next (name, offset, multiquery) pages of the pending queries
+        """
+        per_query = max(1, cls.MULTIQUERY_LIMIT // len(pending))
 
-        genres = {}
-        for genre in r.json():
-            genres[genre['id']] = genre['name']
+        pages = []
+        for name in pending:
+            endpoint, fields, where = queries[name]
+            for i in range(per_query):
+                offset = len(results[name]) + i * cls.LIMIT
+                # Sorted by ID so the pages don't change between requests
+                query = f"fields {fields}; where {where}; sort id asc; limit {cls.LIMIT}; offset {offset};"
+                pages.append((name, offset, (endpoint, f"{name} {offset}", query)))
 
-        return genres
+        return pages
+
+    @classmethod
+    def add_pages(cls, pages, response, results):
+        """
+        Adds the returned pages to the results, returns the queries that still have more pages
+        """
+        pending = []
+        for name, offset, query in pages:
+            page = response[query[1]]
+            results[name] += page
+
+            # Only the last page requested for a query can be full and still be followed by more
+            if len(page) == cls.LIMIT and name not in pending and offset == max(o for n, o, q in pages if n == name):
+                pending.append(name)
+
+        return pending
+
+    @classmethod
+    def batches(cls, ids):
+        """
+        Splits IDs into `where id = (...)` conditions of at most LIMIT IDs
+        """
+        ids = list(ids)
+        return [f"id = ({', '.join(map(str, ids[i:i + cls.LIMIT]))})" for i in range(0, len(ids), cls.LIMIT)]
+
+    # Alternative names, genres and release dates are expanded into each game, already for the whole platform
+    GAME_FIELDS = ("name,updated_at,genres.name,alternative_names.name,"
+                   "release_dates.y,release_dates.region,release_dates.platform")
 
     def download_games(self, platform):
         """
         Downloads all games for a platform
         """
-        games = []
+        return self.query_all({"games": ("games", self.GAME_FIELDS, f"platforms = [{platform}]")})["games"]
 
-        offset = 0
-        while True:
-            r = requests.request("POST", "https://api.igdb.com/v4/games",
-                                 headers=self.headers,
-                                 data=f"fields id,genres,name,release_dates,alternative_names; where platforms = [{platform}]; limit 500;offset {offset};")
-            r.raise_for_status()
-            offset += 500
-            games += r.json()
+    def download_game_ids(self, platform):
+        """
+        Downloads the IDs of all games for a platform
+        """
+        ids = self.query_all({"ids": ("games", "id", f"platforms = [{platform}]")})["ids"]
+        return {game['id'] for game in ids}
+
+    def count_games(self, platform):
+        """
+        Number of games for a platform
+        """
+        return self.post("games/count", f"where platforms = [{platform}];")['count']
 
-            if len(r.json()) < 500:
-                break
+    def updated_queries(self, platform, checkpoint):
+        """
+        Games changed since the checkpoint and release dates changed since the checkpoint, in one multiquery
+        """
+        return {
+            "games": ("games", self.GAME_FIELDS, f"platforms = [{platform}] & updated_at >= {checkpoint}"),
+            "dates": ("release_dates", "game,updated_at", f"platform = {platform} & updated_at >= {checkpoint}")
+        }
 
-        return games
+    def game_queries(self, platform, ids):
+        return {f"games {i}": ("games", self.GAME_FIELDS, f"platforms = [{platform}] & {where}")
+                for i, where in enumerate(self.batches(ids))}
 
-    def download_alternative_names(self, games):
+    def download_updated_games(self, platform, checkpoint):
         """
-        Downloads the alternative names for each game
+        Downloads the games for a platform changed since the checkpoint,
+        including the ones whose release dates changed, and the new checkpoint
         """
-        alternative_names = {}
-        alternative_names_ids = set()
-        for y in games:
-            if 'alternative_names' in y:
-                for x in y['alternative_names']:
-                    alternative_names_ids.add(x)
-        alternative_names_ids = list(alternative_names_ids)
+        updated = self.query_all(self.updated_queries(platform, checkpoint))
+        games = {game['id']: game for game in updated["games"]}
 
-        while True:
-            ids = alternative_names_ids[:500]
-            alternative_names_ids = alternative_names_ids[500:]
-            r = requests.request("POST", "https://api.igdb.com/v4/alternative_names",
-                                 headers=self.headers,
-                                 data=f"fields name; where id = ({', '.join(map(str, ids))}); limit 500;")
-            r.raise_for_status()
+        ids, checkpoint = self.updated_date_games(games, updated["dates"], checkpoint)
+        for batch in self.query_all(self.game_queries(platform, ids)).values():
+            for game in batch:
+                games[game['id']] = game
 
-            for name in r.json():
-                alternative_names[name['id']] = name['name']
+        return list(games.values()), checkpoint
 
-            if len(alternative_names_ids) == 0:
-                break
+    @staticmethod
+    def updated_date_games(games, dates, checkpoint):
+        """
+        Games not in `games` with updated release dates, and the checkpoint moved past those dates
+        """
+        game_ids = set()
+        for date in dates:
+            checkpoint = max(checkpoint, date['updated_at'])
+            if 'game' in date and date['game'] not in games:
+                game_ids.add(date['game'])
 
-        return alternative_names
+        return sorted(game_ids), checkpoint
 
-    def download_release_dates(self, platform):
+    def download_console(self, platform, file_name):
         """
-        Downloads all release dates for a given platform
+        Downloads a platform into dbs/file_name
+
+        If a previous dump and its checkpoint exist only the games updated since then are downloaded
+        and merged into it by ID, otherwise the whole platform is downloaded again
         """
-        release_dates = {}
+        checkpoint, stored = self.load_console(platform, file_name)
 
-        offset = 0
-        while True:
-            r = requests.request("POST", "https://api.igdb.com/v4/release_dates",
-                                 headers=self.headers,
-                                 data=f"fields id,y,region; where platform = {platform}; limit 500; offset {offset};")
-            r.raise_for_status()
-            offset += 500
+        # Only saved along with the dump, a failed platform keeps its old checkpoint
+        if stored is None:
+            games, latest = self.download_games(platform), 0
+        else:
+            games, latest = self.download_updated_games(platform, checkpoint)
 
-            resp_json = r.json()
-            for date in resp_json:
-                # TODO: id 203063 has region 9 for some reason
-                date['region'] = self.regions.get(date['region'], 'worldwide')
-                release_dates[date['id']] = date
-                del release_dates[date['id']]['id']
+        n_games, latest = self.substitute(platform, games, latest)
 
-            if len(resp_json) < 500:
-                break
+        if stored is not None:
+            n_games = self.merge(platform, checkpoint, stored, n_games)
 
-        return release_dates
+            # Deleted games don't show up as updates, look for them only when the totals differ
+            if len(n_games) != self.count_games(platform):
+                n_games = self.remove_deleted(n_games, self.download_game_ids(platform))
 
-    def download_console(self, platform, file_name):
+        self.save_console(platform, file_name, n_games, latest)
+
+    def load_console(self, platform, file_name):
+        """
+        Checkpoint and games by ID of the previous dump, or no games if it has to be downloaded again
+        """
+        checkpoint = self.checkpoints.get(str(platform))
+        if checkpoint is None or not os.path.exists(f'dbs/{file_name}'):
+            return None, None
 
-        games = self.download_games(platform)
-        alternative_names = self.download_alternative_names(games)
-        release_dates = self.download_release_dates(platform)
+        with open(f'dbs/{file_name}') as f:
+            return checkpoint, {game['id']: game for game in json.load(f)}
 
-        # substitute all release_dates and alternative_names
+    def substitute(self, platform, games, checkpoint):
+        """
+        Replace the expanded alternative_names, release_dates and genres of the downloaded games
+        with the values stored in the dumps, also returns the checkpoint moved past their updates
+        """
         n_games = []
         for game in games:
             if 'alternative_names' in game:
-                names = game['alternative_names']
-                game['alternative_names'] = []
-                for name in names:
-                    game['alternative_names'].append(alternative_names[name])
+                game['alternative_names'] = [name['name'] for name in game['alternative_names']]
 
             if 'release_dates' in game:
                 dates = game['release_dates']
                 game['release_dates'] = []
                 for date in dates:
-                    if date in release_dates:
-                        game['release_dates'].append(release_dates[date])
+                    # Release dates of the other platforms of the game
+                    if date.get('platform') != platform:
+                        continue
+                    del date['id']
+                    del date['platform']
+                    # TODO: id 203063 has region 9 for some reason
+                    date['region'] = self.regions.get(date['region'], 'worldwide')
+                    game['release_dates'].append(date)
 
             if 'genres' in game:
-                game_genres = game['genres']
-                game['genres'] = []
-                for genre in game_genres:
-                    game['genres'].append(self.convert_genre(self.genres[genre]))
+                game['genres'] = [self.convert_genre(genre['name']) for genre in game['genres']]
 
+            checkpoint = max(checkpoint, game.pop('updated_at', 0))
             n_games.append(game)
 
+        return n_games, checkpoint
+
+    @staticmethod
+    def merge(platform, checkpoint, stored, n_games):
+        logging.info(f"Platform {platform}: {len(n_games)} games updated since {checkpoint}")
+        for game in n_games:
+            stored[game['id']] = game
+
+        return sorted(stored.values(), key=lambda game: game['id'])
+
+    @staticmethod
+    def remove_deleted(games, ids):
+        return [game for game in games if game['id'] in ids]
+
+    def save_console(self, platform, file_name, n_games, checkpoint):
         if not os.path.exists("./dbs"):
             os.mkdir("./dbs")
-        with open(f'dbs/{file_name}', 'w') as f:
+        with open(f'dbs/{file_name}.tmp', 'w') as f:
             json.dump(n_games, f)
+        os.replace(f'dbs/{file_name}.tmp', f'dbs/{file_name}')
+
+        self.store.save_dump(file_name, n_games, self.normalizer)
+        metrics.count('igdb_games', len(n_games))
+
+        # Save after every platform so a failed run only repeats the rest. Only this platform's
+        # checkpoint is written, the others are still being downloaded or kept from the last run
+        checkpoints = {}
+        if os.path.exists(self.CHECKPOINTS):
+            with open(self.CHECKPOINTS) as f:
+                checkpoints = json.load(f)
+        checkpoints[str(platform)] = checkpoint
+        with open(f'{self.CHECKPOINTS}.tmp', 'w') as f:
+            json.dump(checkpoints, f)
+        os.replace(f'{self.CHECKPOINTS}.tmp', self.CHECKPOINTS)
 
     @staticmethod
     def convert_genre(genre):
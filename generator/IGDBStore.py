@@ -0,0 +1,123 @@
+import os
+import sqlite3
+
+
+class IGDBStore():
+    """
+    SQLite copy of the IGDB dumps with every name already normalized
+
+    Rows keep their position in the dump, so the candidates come out in the same
+    order as when they are built from the JSON file
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dumps (dump TEXT PRIMARY KEY, normalizer INTEGER);
+        CREATE TABLE IF NOT EXISTS games (dump TEXT, id INTEGER, name TEXT, PRIMARY KEY (dump, id));
+        CREATE TABLE IF NOT EXISTS alternative_names (dump TEXT, game INTEGER, position INTEGER, name TEXT);
+        CREATE TABLE IF NOT EXISTS release_dates (dump TEXT, game INTEGER, position INTEGER, y INTEGER, region TEXT);
+        CREATE TABLE IF NOT EXISTS genres (dump TEXT, game INTEGER, position INTEGER, name TEXT);
+        CREATE TABLE IF NOT EXISTS names (dump TEXT, position INTEGER, name TEXT, normalized TEXT, game INTEGER);
+        CREATE INDEX IF NOT EXISTS alternative_names_game ON alternative_names (dump, game, position);
+        CREATE INDEX IF NOT EXISTS release_dates_game ON release_dates (dump, game, position);
+        CREATE INDEX IF NOT EXISTS genres_game ON genres (dump, game, position);
+        CREATE INDEX IF NOT EXISTS names_position ON names (dump, position);
+        CREATE INDEX IF NOT EXISTS names_normalized ON names (dump, normalized);
+    """
+
+    TABLES = ['dumps', 'games', 'alternative_names', 'release_dates', 'genres', 'names']
+
+    def __init__(self, path='dbs/igdb.sqlite'):
+        self.path = path
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path)
+            self.db.executescript(self.SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def save_dump(self, dump, games, normalizer):
+        """
+        Replaces a dump with a list of games in the same shape as the JSON files
+        """
+        db = self.connect()
+        with db:
+            for table in self.TABLES:
+                db.execute(f"DELETE FROM {table} WHERE dump = ?", (dump,))
+            db.execute("INSERT INTO dumps VALUES (?, ?)", (dump, normalizer.VERSION))
+
+            names = []
+            for game in games:
+                db.execute("INSERT INTO games VALUES (?, ?, ?)", (dump, game['id'], game['name']))
+                names.append((game['name'], game['id']))
+
+                for i, name in enumerate(game.get('alternative_names', [])):
+                    db.execute("INSERT INTO alternative_names VALUES (?, ?, ?, ?)", (dump, game['id'], i, name))
+                    names.append((name, game['id']))
+                for i, date in enumerate(game.get('release_dates', [])):
+                    db.execute("INSERT INTO release_dates VALUES (?, ?, ?, ?, ?)",
+                               (dump, game['id'], i, date.get('y'), date.get('region')))
+                for i, genre in enumerate(game.get('genres', [])):
+                    db.execute("INSERT INTO genres VALUES (?, ?, ?, ?)", (dump, game['id'], i, genre))
+
+            normalized = normalizer.normalize_many([name for name, game in names])
+            db.executemany("INSERT INTO names VALUES (?, ?, ?, ?, ?)",
+                           [(dump, i, name, norm, game) for i, ((name, game), norm) in enumerate(zip(names, normalized))])
+
+    def has_dump(self, dump):
+        if not os.path.exists(self.path):
+            return False
+        return self.connect().execute("SELECT 1 FROM dumps WHERE dump = ?", (dump,)).fetchone() is not None
+
+    def candidates(self, dump, normalizer):
+        """
+        Normalized name -> game ID, the last game wins but the name keeps its first position
+        """
+        version = self.connect().execute("SELECT normalizer FROM dumps WHERE dump = ?", (dump,)).fetchone()[0]
+        rows = self.db.execute("SELECT name, normalized, game FROM names WHERE dump = ? ORDER BY position", (dump,))
+
+        # Names normalized by an older version are normalized again
+        if version != normalizer.VERSION:
+            rows = [(name, normalizer.normalize(name), game) for name, normalized, game in rows]
+
+        games = {}
+        for name, normalized, game in rows:
+            games[normalized] = game
+        return games
+
+    def game(self, dump, game_id):
+        """
+        A game in the same shape as in the JSON files
+        """
+        db = self.connect()
+        name, = db.execute("SELECT name FROM games WHERE dump = ? AND id = ?", (dump, game_id)).fetchone()
+        game = {'id': game_id, 'name': name}
+
+        alternative_names = db.execute(
+            "SELECT name FROM alternative_names WHERE dump = ? AND game = ? ORDER BY position", (dump, game_id))
+        alternative_names = [name for name, in alternative_names]
+        if alternative_names:
+            game['alternative_names'] = alternative_names
+
+        release_dates = []
+        for y, region in db.execute(
+                "SELECT y, region FROM release_dates WHERE dump = ? AND game = ? ORDER BY position", (dump, game_id)):
+            date = {'region': region}
+            if y is not None:
+                date['y'] = y
+            release_dates.append(date)
+        if release_dates:
+            game['release_dates'] = release_dates
+
+        genres = db.execute("SELECT name FROM genres WHERE dump = ? AND game = ? ORDER BY position", (dump, game_id))
+        genres = [name for name, in genres]
+        if genres:
+            game['genres'] = genres
+
+        return game
@@ -0,0 +1,109 @@
+from bisect import bisect_left
+from fuzzywuzzy import fuzz
+from FuzzyMatcher import FuzzyMatcher
+import fuzzywuzzy
+import json
+import os
+
+
+class MatchCache():
+    """
+    On-disk cache of the fuzzy matches of a platform between runs
+
+    Stores the ordered candidate keys next to the best match of every ROM title.
+    If the candidates changed, a cached match is kept only if its candidate
+    still exists, and only the added or moved candidates are scored against that title
+    """
+
+    # Bump when the matching logic changes to discard old caches
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+
+        # Scores depend on the fuzzywuzzy version and backend
+        self.scorer = f"fuzzywuzzy {fuzzywuzzy.__version__} {fuzz.SequenceMatcher.__module__} v{self.VERSION}"
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.data = json.load(f)
+            if self.data.get('scorer') != self.scorer:
+                self.data = {}
+
+    @staticmethod
+    def in_order(choices, positions):
+        """
+        Longest subsequence of choices that kept its relative order in positions
+        """
+        tails = []
+        tail_positions = []
+        previous = {}
+        for choice in choices:
+            i = bisect_left(tail_positions, positions[choice])
+            previous[choice] = tails[i - 1] if i > 0 else None
+            if i == len(tails):
+                tails.append(choice)
+                tail_positions.append(positions[choice])
+            else:
+                tails[i] = choice
+                tail_positions[i] = positions[choice]
+
+        ordered = set()
+        choice = tails[-1] if tails else None
+        while choice is not None:
+            ordered.add(choice)
+            choice = previous[choice]
+        return ordered
+
+    def restore(self, name, matcher, titles):
+        """
+        Fill the matcher with the cached matches that are still valid for its candidates
+        """
+        if name not in self.data:
+            return 0
+
+        old_choices = self.data[name]['choices']
+        cached = self.data[name]['matches']
+        positions = {choice: i for i, choice in enumerate(matcher.choices)}
+
+        # extractOne keeps the first of several equal scores, so besides the added
+        # candidates, the ones that moved relative to the rest can also change a match
+        kept = [choice for choice in old_choices if choice in positions]
+        changed = set(matcher.choices) - set(kept)
+        changed |= set(kept) - self.in_order(kept, positions)
+        changed_matcher = FuzzyMatcher([choice for choice in matcher.choices if choice in changed])
+
+        restored = 0
+        for title in titles:
+            if cached.get(title) is None:
+                continue
+            choice, score = cached[title]
+
+            # The rest of the candidates may have moved before it, score the title again
+            if choice not in positions or choice in changed:
+                continue
+
+            # Only a changed candidate can beat the cached match
+            match = changed_matcher.search(title)
+            if match is not None and (match[1] > score or
+                                      (match[1] == score and positions[match[0]] < positions[choice])):
+                choice, score = match
+
+            matcher.matches[title] = (choice, score)
+            restored += 1
+
+        matcher.comparisons += changed_matcher.comparisons
+
+        return restored
+
+    def store(self, name, matcher):
+        self.data[name] = {'choices': matcher.choices, 'matches': matcher.matches}
+
+    def save(self):
+        self.data['scorer'] = self.scorer
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(self.data, f)
+        os.replace(f'{self.path}.tmp', self.path)
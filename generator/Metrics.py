@@ -0,0 +1,88 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+
+
+class Metrics():
+    """
+    Stage timers and counters of a run
+
+    Stages nest, a stage started inside another one is named "outer/inner". Counters can
+    be increased from any thread. With a profile folder, every top level stage is also
+    run under cProfile, which only sees the main process
+    """
+
+    # Functions listed in the text summary of a profile
+    PROFILE_LINES = 50
+
+    def __init__(self):
+        self.stages = []
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+        self.stack = []
+        self.profile_dir = None
+        self.start = time.time()
+
+    @staticmethod
+    def max_rss():
+        """
+        Peak resident memory in KB of this process and of its finished children
+        """
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    @contextmanager
+    def stage(self, name):
+        self.stack.append(name)
+
+        profile = None
+        if self.profile_dir is not None and len(self.stack) == 1:
+            profile = cProfile.Profile()
+            profile.enable()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+                self.save_profile(name, profile)
+
+            self.stack.pop()
+            self.record(name, seconds)
+
+    def record(self, name, seconds):
+        """
+        Add a stage inside the current one, for stages timed somewhere else like in a worker process
+        """
+        with self.lock:
+            self.stages.append({'stage': '/'.join(self.stack + [name]), 'seconds': round(seconds, 3),
+                                'max_rss_kb': self.max_rss()})
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def save_profile(self, name, profile):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        profile.dump_stats(f'{self.profile_dir}/{name}.prof')
+        with open(f'{self.profile_dir}/{name}.txt', 'w') as f:
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(self.PROFILE_LINES)
+
+    def save(self, path):
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({'start': self.start, 'seconds': round(time.time() - self.start, 3),
+                       'max_rss_kb': self.max_rss(), 'stages': self.stages,
+                       'counters': dict(sorted(self.counters.items()))}, f, indent=4)
+        os.replace(f'{path}.tmp', path)
+
+
+# Shared by every stage, main.py writes it out at the end of the run
+metrics = Metrics()
@@ -0,0 +1,62 @@
+from functools import lru_cache
+from stop_words import get_stop_words
+import os
+import unicodedata
+
+
+class Normalizer():
+    """
+    Normalizes ROM names, cover file names and IGDB names into fuzzy matching keys
+
+    Results are memoized, as the same names show up in several platforms
+    """
+
+    # Bump when the normalization changes, names stored by IGDBStore are normalized again
+    VERSION = 1
+
+    # Replaced in this order before the single character substitutions
+    NUMERALS = [(' ii', ' 2'), (' iii', ' 3'), (' iv', '4')]
+
+    SUBSTITUTIONS = str.maketrans({'!': '', '-': ' ', ':': '', '\'': '', '~': ' ', ',': '', '&': '', '+': '',
+                                   '_': ' ', '/': '', '.': '', '*': ' '})
+
+    def __init__(self, maxsize=65536):
+        stop_words = [word.replace('\'', '') for word in get_stop_words('en')]
+        stop_words.remove('same')
+
+        # Add some mor stopwords manually
+        stop_words.append('les')
+        stop_words.append('la')
+
+        self.STOP_WORDS = frozenset(stop_words)
+        self.maxsize = maxsize
+        self.normalize = lru_cache(maxsize=maxsize)(self._normalize)
+
+    def __getstate__(self):
+        # The memo can't be pickled, worker processes start with an empty one
+        return {'STOP_WORDS': self.STOP_WORDS, 'maxsize': self.maxsize}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.normalize = lru_cache(maxsize=self.maxsize)(self._normalize)
+
+    def _normalize(self, name):
+        # ASCII names have nothing to decompose
+        if not name.isascii():
+            nfkd_form = unicodedata.normalize('NFKD', name)
+            name = u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
+
+        norm = os.path.splitext(name)[0]
+
+        norm = norm.lower()
+        for numeral, number in self.NUMERALS:
+            norm = norm.replace(numeral, number)
+        norm = norm.translate(self.SUBSTITUTIONS)
+
+        if '(' in norm:
+            norm = norm.split('(')[0]
+
+        return ''.join([word for word in norm.split() if word not in self.STOP_WORDS])
+
+    def normalize_many(self, names):
+        return list(map(self.normalize, names))
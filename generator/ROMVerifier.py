@@ -0,0 +1,130 @@
+from concurrent.futures import ProcessPoolExecutor
+from csv import DictWriter
+from GameDB import NS
+from lxml import etree
+from XMLBuilder import XMLGenerator
+from zipfile import ZipFile
+import glob
+import logging
+import os
+import re
+
+
+def rom_crc(path):
+    """
+    MegaSD CRC of a ROM or cue sheet, None and the error if it can't be read
+    """
+    try:
+        return XMLGenerator.crc(path).zfill(8), None
+    except (OSError, UnicodeDecodeError, ValueError) as e:
+        return None, str(e)
+
+
+class ROMVerifier():
+    """
+    Checks a ROM collection against the GameCk checksums of a generated DB
+
+    Every ROM and cue sheet under the folder is hashed in a process pool, bin files named
+    by a cue sheet are covered by its CRC. The report lists each file as Matched, Unknown,
+    Duplicate (same CRC as a file listed before it) or Error
+    """
+
+    # Extensions hashed as plain ROMs
+    ROM_EXTENSIONS = ['.md', '.gen', '.bin', '.sms', '.32x', '.sg']
+
+    def __init__(self, folder, db_zip=None, report='verify_roms.csv'):
+        logging.info(f"Verifying ROMs in {folder}")
+
+        # Latest generated DB by default
+        if db_zip is None:
+            zips = sorted(glob.glob('DB_????-??-??.zip'))
+            if not zips:
+                raise Exception("No DB ZIP file found, generate one with --generate-xml")
+            db_zip = zips[-1]
+
+        self.checksums, self.games = self.load_db(db_zip)
+        files = self.find_roms(folder)
+
+        with ProcessPoolExecutor() as executor:
+            crcs = list(executor.map(rom_crc, files, chunksize=16))
+
+        self.write_report(folder, files, crcs, report)
+
+    @staticmethod
+    def load_db(db_zip):
+        """
+        Checksum -> game ID and game ID -> name from the db.xml of a DB ZIP file
+        """
+        checksums = {}
+        games = {}
+
+        with ZipFile(db_zip) as zipObj, zipObj.open('db.xml') as f:
+            for _, element in etree.iterparse(f, tag=[f'{{{NS}}}Game', f'{{{NS}}}GameCk']):
+                fields = {etree.QName(child).localname: child.text for child in element}
+                if etree.QName(element).localname == 'Game':
+                    games[fields['ID']] = fields['Name']
+                else:
+                    checksums[fields['Checksum'].upper()] = fields['GameID']
+                element.clear()
+
+        logging.info(f"{len(checksums)} checksums in {db_zip}")
+        return checksums, games
+
+    def find_roms(self, folder):
+        """
+        Every ROM and cue sheet under folder, except the bin files of the cue sheets
+        """
+        cues = []
+        roms = []
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for f in sorted(files):
+                ext = os.path.splitext(f)[1].lower()
+                if ext == '.cue':
+                    cues.append(os.path.join(root, f))
+                elif ext in self.ROM_EXTENSIONS:
+                    roms.append(os.path.join(root, f))
+
+        tracks = set()
+        for cue in cues:
+            with open(cue, errors='replace') as f:
+                for line in f:
+                    track = re.match(r'\s*FILE\s+"(.+)"', line)
+                    if track is not None:
+                        tracks.add(os.path.normcase(os.path.join(os.path.dirname(cue), track.group(1))))
+
+        return cues + [rom for rom in roms if os.path.normcase(rom) not in tracks]
+
+    def write_report(self, folder, files, crcs, report):
+        counts = {'Matched': 0, 'Unknown': 0, 'Duplicate': 0, 'Error': 0}
+
+        # CRC -> first file that had it
+        seen = {}
+
+        with open(report, 'w', newline='') as f:
+            writer = DictWriter(f, fieldnames=["File", "CRC", "Status", "Game ID", "Game", "Duplicate Of", "Error"])
+            writer.writeheader()
+
+            for path, (crc, error) in zip(files, crcs):
+                row = {"File": os.path.relpath(path, folder), "CRC": crc}
+                if crc is None:
+                    row["Status"] = 'Error'
+                    row["Error"] = error
+                elif crc in seen:
+                    row["Status"] = 'Duplicate'
+                    row["Duplicate Of"] = seen[crc]
+                else:
+                    seen[crc] = row["File"]
+                    row["Status"] = 'Matched' if crc in self.checksums else 'Unknown'
+
+                if crc in self.checksums:
+                    row["Game ID"] = self.checksums[crc]
+                    row["Game"] = self.games.get(self.checksums[crc])
+
+                counts[row["Status"]] += 1
+                writer.writerow(row)
+
+        logging.info(f"ROMs: {len(files)}")
+        for status, count in counts.items():
+            logging.info(f"{status}: {count}")
+        logging.info(f"Report written to {report}\n")
@@ -0,0 +1,157 @@
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+import os
+import struct
+import zlib
+
+
+class ReleaseZip():
+    """
+    Deterministic release ZIP file builder
+
+    Members are written in the order they are added, all with the same timestamp.
+    Text members are deflated and PNGs, which are already compressed, are stored.
+    Members are compressed in parallel, and a deflated member with the same content
+    as in the previous release is copied from it without compressing it again
+    """
+
+    # Extensions worth deflating, everything else is stored
+    DEFLATED_EXTENSIONS = ['.xml', '.csv', '.json']
+    LEVEL = 9
+
+    # Bytes copied at a time for stored members
+    BUFFER_SIZE = 1024 * 1024
+
+    # ZIP format limits before the ZIP64 records are needed
+    MAX_ENTRIES = 0xFFFF
+    MAX_OFFSET = 0xFFFFFFFF
+
+    def __init__(self, path, date_time, previous=None):
+        self.path = path
+        self.date_time = date_time
+        self.previous = previous
+        self.members = []
+
+        # Members copied from the previous release by the last build
+        self.reused = 0
+
+    def add_file(self, name, path):
+        self.members.append((name, path))
+
+    def add_bytes(self, name, data):
+        self.members.append((name, data))
+
+    def compress_type(self, name):
+        return ZIP_DEFLATED if os.path.splitext(name)[1].lower() in self.DEFLATED_EXTENSIONS else ZIP_STORED
+
+    def chunks(self, source):
+        """
+        Content of a member in BUFFER_SIZE pieces, from its bytes or its file
+        """
+        if isinstance(source, bytes):
+            view = memoryview(source)
+            for offset in range(0, len(view), self.BUFFER_SIZE):
+                yield view[offset:offset + self.BUFFER_SIZE]
+            return
+
+        with open(source, 'rb') as f:
+            while data := f.read(self.BUFFER_SIZE):
+                yield data
+
+    def prepare(self, member, previous):
+        """
+        CRC, size, compression, the data to write (None to copy the source) and whether it was reused
+        """
+        name, source = member
+        compress_type = self.compress_type(name)
+
+        crc = 0
+        size = 0
+        for data in self.chunks(source):
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+
+        # Stored members are copied while writing the ZIP file, no need to keep them in memory
+        if compress_type == ZIP_STORED:
+            return crc, size, compress_type, None, False
+
+        # Same content as in the previous release, copy its compressed data
+        info = previous.get(name)
+        if info is not None and info.CRC == crc and info.file_size == size \
+                and info.compress_type == compress_type:
+            return crc, size, compress_type, self.read_raw(info), True
+
+        # Compressed piece by piece, only the compressed data is kept in memory
+        compressor = zlib.compressobj(self.LEVEL, zlib.DEFLATED, -15)
+        compressed = [compressor.compress(data) for data in self.chunks(source)]
+        compressed.append(compressor.flush())
+        return crc, size, compress_type, b''.join(compressed), False
+
+    def read_raw(self, info):
+        """
+        Compressed data of a member of the previous release
+        """
+        with open(self.previous, 'rb') as f:
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            return f.read(info.compress_size)
+
+    def build(self):
+        previous = {}
+        if self.previous is not None and os.path.exists(self.previous):
+            with ZipFile(self.previous) as zipObj:
+                previous = {info.filename: info for info in zipObj.infolist()}
+
+        self.reused = 0
+        with ThreadPoolExecutor() as executor:
+            prepared = executor.map(lambda member: self.prepare(member, previous), self.members)
+
+            year, month, day, hour, minute, second = self.date_time
+            dos_time = hour << 11 | minute << 5 | second // 2
+            dos_date = (year - 1980) << 9 | month << 5 | day
+
+            central = []
+            with open(f'{self.path}.tmp', 'wb') as f:
+                for (name, source), (crc, size, compress_type, data, reused) in zip(self.members, prepared):
+                    self.reused += reused
+                    offset = f.tell()
+                    compress_size = size if data is None else len(data)
+                    if max(offset, compress_size, size) > self.MAX_OFFSET:
+                        raise Exception(f"{name} doesn't fit in a ZIP file without ZIP64 members")
+
+                    encoded = name.encode('utf-8')
+                    flags = 0 if name.isascii() else 0x800
+                    fields = (20, flags, compress_type, dos_time, dos_date, crc, compress_size, size, len(encoded), 0)
+                    f.write(struct.pack('<IHHHHHIIIHH', 0x04034b50, *fields))
+                    f.write(encoded)
+
+                    if data is None:
+                        for chunk in self.chunks(source):
+                            f.write(chunk)
+                    else:
+                        f.write(data)
+
+                    central.append(struct.pack('<IH', 0x02014b50, 3 << 8 | 20) +
+                                   struct.pack('<HHHHHIIIHHHHHII', *fields, 0, 0, 0, 0o644 << 16, offset) + encoded)
+
+                self.write_central_directory(f, central)
+        os.replace(f'{self.path}.tmp', self.path)
+
+    def write_central_directory(self, f, central):
+        offset = f.tell()
+        for entry in central:
+            f.write(entry)
+        size = f.tell() - offset
+
+        entries = len(central)
+        if entries >= self.MAX_ENTRIES or offset > self.MAX_OFFSET:
+            # ZIP64 end of central directory record and its locator
+            zip64 = f.tell()
+            f.write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, entries, entries, size, offset))
+            f.write(struct.pack('<IIQI', 0x07064b50, 0, zip64, 1))
+            entries = min(entries, self.MAX_ENTRIES)
+            offset = min(offset, self.MAX_OFFSET)
+
+        f.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, entries, entries, size, offset, 0))
@@ -0,0 +1,92 @@
+import io
+import requests
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only file backed by HTTP range requests
+
+    zipfile only reads the end of central directory, the central directory and the
+    members that are opened, so a ZipFile on top of it downloads just those parts.
+    Reads are rounded to BLOCK_SIZE blocks, consecutive missing blocks are fetched
+    in a single request
+    """
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, url, length, get=None):
+        self.url = url
+        self.length = length
+        # Sends a GET with the given headers
+        self.get = get or (lambda headers: requests.get(url, headers=headers))
+        self.position = 0
+        self.blocks = {}
+        self.fetched = 0
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.length + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+
+        if self.position < 0:
+            raise OSError(f"Negative seek position {self.position}")
+        return self.position
+
+    def fetch(self, first, last):
+        """
+        Download blocks first to last (inclusive) in one request
+        """
+        start = first * self.BLOCK_SIZE
+        end = min((last + 1) * self.BLOCK_SIZE, self.length) - 1
+
+        r = self.get({'Range': f'bytes={start}-{end}'})
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise Exception(f"{self.url} doesn't support range requests")
+        if len(r.content) != end - start + 1:
+            raise Exception(f"{self.url} returned {len(r.content)} bytes for range {start}-{end}")
+
+        self.requests += 1
+        self.fetched += len(r.content)
+        for block in range(first, last + 1):
+            offset = (block - first) * self.BLOCK_SIZE
+            self.blocks[block] = r.content[offset:offset + self.BLOCK_SIZE]
+
+    def readinto(self, b):
+        size = min(len(b), self.length - self.position)
+        if size <= 0:
+            return 0
+
+        first = self.position // self.BLOCK_SIZE
+        last = (self.position + size - 1) // self.BLOCK_SIZE
+
+        # Fetch every run of missing blocks
+        missing = None
+        for block in range(first, last + 2):
+            if block <= last and block not in self.blocks:
+                if missing is None:
+                    missing = block
+            elif missing is not None:
+                self.fetch(missing, block - 1)
+                missing = None
+
+        data = b''.join(self.blocks[block] for block in range(first, last + 1))
+        offset = self.position - first * self.BLOCK_SIZE
+        b[:size] = data[offset:offset + size]
+        self.position += size
+        return size
@@ -1,24 +1,135 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from csv import DictWriter
 from datetime import date
-from fuzzywuzzy import process
+from CoverIndex import CoverIndex
+from DeltaPackage import DeltaPackage
+from FuzzyMatcher import FuzzyMatcher
+from GameDB import NS
+from IGDBStore import IGDBStore
 from io import StringIO
 from lxml import etree, objectify
-from stop_words import get_stop_words
-from xml.dom import minidom
-from zipfile import ZipFile
+from MatchCache import MatchCache
+from Metrics import metrics
+from Normalizer import Normalizer
+from ReleaseZip import ReleaseZip
 import glob
 import json
 import logging
 import os
-import re
-import unicodedata
+import tempfile
+import time
 import zlib
 
 
-class XMLGenerator():
+class GameDBWriter():
+    """
+    Writes GameDB records into a stream as they are produced, instead of
+    building the whole tree in memory. The output is the same as minidom's toprettyxml:
+    text is escaped like minidom does, quotes included, and empty elements are self-closed
+    """
+
+    NS = NS
+
+    def __init__(self, stream, xmlschema):
+        self.stream = stream
+        self.xmlschema = xmlschema
+
+    def __enter__(self):
+        self.stream.write(f'<?xml version="1.0" ?>\n<ns0:GameDB xmlns:ns0="{self.NS}">'.encode())
+        return self
+
+    def __exit__(self, *exc):
+        self.stream.write(b'\n</ns0:GameDB>\n')
+
+    @staticmethod
+    def escape(text):
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+    def write_record(self, tag, fields):
+        """
+        Validate a single Game, GameCk or Genre record and write it
+        """
+        a = etree.Element(f'{{{self.NS}}}GameDB')
+        b = etree.SubElement(a, f'{{{self.NS}}}{tag}')
+        for field, text in fields:
+            etree.SubElement(b, f'{{{self.NS}}}{field}').text = text
+
+        # Validate schema - Exception thrown if not valid
+        # IDs and checksums are unique by construction, so the record alone is validated
+        try:
+            self.xmlschema.assertValid(etree.ElementTree(a))
+        except Exception as e:
+            print(e)
+            pass
+
+        record = [f'\n    <ns0:{tag}>']
+        for field, text in fields:
+            if text:
+                record.append(f'\n        <ns0:{field}>{self.escape(text)}</ns0:{field}>')
+            else:
+                record.append(f'\n        <ns0:{field}/>')
+        record.append(f'\n    </ns0:{tag}>')
+        self.stream.write(''.join(record).encode())
+
+
+class CRCRegistry():
+    """
+    Checksums already added to the DB, keyed by their uint32 value
+    """
+
     def __init__(self):
+        # CRC -> (ROM, platform) that added it
+        self.crcs = {}
+
+    def add(self, crc, rom, platform):
+        """
+        Register a checksum, returns the (ROM, platform) that already had it or None if it's new
+        """
+        key = int(crc, 16)
+        if key in self.crcs:
+            return self.crcs[key]
+
+        self.crcs[key] = (rom, platform)
+        return None
+
+
+class XMLGenerator():
+    # (DAT name, ROM extension, covers folder, IGDB dump) in the order they are added to the XML
+    PLATFORMS = [
+        ('Mega Drive - Genesis', '*.md', 'output/Sega - Mega Drive - Genesis/Named_Titles', 'dbs/genesis.json'),
+        ('Master System - Mark III', '*.sms', 'output/Sega - Master System - Mark III/Named_Titles', 'dbs/ms.json'),
+        ('32X', '*.32x', 'output/Sega - 32X/Named_Titles', 'dbs/32x.json'),
+        ('SG-1000', '*.sg', 'output/Sega - SG-1000/Named_Titles', 'dbs/sg1000.json'),
+        ('Sega - Mega CD & Sega CD - Datfile (MegaSD).dat', '*.cue', 'output/Sega - Mega CD & Sega CD/Named_Titles', 'dbs/cd.json')
+    ]
+
+    # Genre IDs are their position in this list, starting at 1
+    GENRES = ['Shooter', 'Action', 'Sports', 'Misc', 'Casino', 'Driving', 'Platform', 'Puzzle', 'Boxing', 'Wrestling',
+              'Strategy', 'Soccer', 'Golf', 'Beat\'Em-Up', 'Baseball', 'Mahjong', 'Board', 'Tennis', 'Fighter',
+              'Horse Racing', 'Other']
+
+    # Bytes read at a time by crc
+    CRC_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, check_parity=False, batch=False, use_cache=True, previous_release=None, delta_package=False):
         logging.info("Generating DB XML")
+
+        # Also run the linear fuzzy search and report any difference with the indexed one
+        self.check_parity = check_parity
+
+        # Score all ROMs of a platform at once with rapidfuzz instead of one by one
+        self.batch = batch
+
+        # Reuse the fuzzy matches of the previous run when they are still valid
+        self.use_cache = use_cache
+
+        # Release ZIP file to copy unchanged members from, the latest DB_*.zip by default
+        self.previous_release = previous_release
+
+        # Also write an update package from the previous release to the new one
+        self.delta_package = delta_package
+
         self.cfm = StringIO()
         self.cfmw = DictWriter(self.cfm, fieldnames=["ROM", "Cover", "Score"])
         self.cfmw.writeheader()
@@ -27,29 +138,31 @@ class XMLGenerator():
         self.ifmw = DictWriter(self.ifm, fieldnames=["ROM", "DB Entry", "Score"])
         self.ifmw.writeheader()
 
+        self.ccm = StringIO()
+        self.ccmw = DictWriter(self.ccm, fieldnames=["CRC", "ROM", "Platform", "Dropped ROM", "Dropped Platform"])
+        self.ccmw.writeheader()
+
+        self.coc = StringIO()
+        self.cocw = DictWriter(self.coc, fieldnames=["Cover Key", "Cover", "Dropped Cover", "Same Image"])
+        self.cocw.writeheader()
+
         # Store some info to later put in the GitHub release as markdown
         self.release_md = "| System | Info | Covers |%0A| --- | --- | --- |%0A"
 
-        self.STOP_WORDS = get_stop_words('en')
-        self.STOP_WORDS = [word.replace('\'', '') for word in self.STOP_WORDS]
-        self.STOP_WORDS.remove('same')
-
-        # Add some mor stopwords manually
-        self.STOP_WORDS.append('les')
-        self.STOP_WORDS.append('la')
+        self.normalizer = Normalizer()
 
         # Unique counter per game
         self.COUNTER = 0
 
         # Some geneis sgames have same CRC as Master system games?
-        self.hashes = []
+        self.crcs = CRCRegistry()
 
-        try:
-            # Generate XML
-            XMLStr = self.run()
+        # Covers used by a game, the only ones in the release
+        self.screenshots = set()
 
-            # Generate release ZIP file
-            self.generate_zip(XMLStr)
+        try:
+            # Generate XML and the release ZIP file
+            self.generate_zip()
 
             # Release text for Github
             if os.environ.get("GITHUB_ACTIONS"):
@@ -59,198 +172,88 @@ class XMLGenerator():
             # Close files
             self.cfm.close()
             self.ifm.close()
-
-    def generate_zip(self, XMLStr):
-        # create a ZipFile object
-        zipObj = ZipFile(f'DB_{date.today()}.zip', 'w')
-
-        # Add multiple files to the zip
-        zipObj.writestr("db.xml", XMLStr)
-        zipObj.writestr("cover_fuzzy_matches.csv", self.cfm.getvalue())
-        zipObj.writestr("info_fuzzy_matches.csv", self.ifm.getvalue())
-
-        # Insert images
-        for root, dirs, files in os.walk('output'):
-            for f in files:
-                zipObj.write(os.path.join(root, f))
-
-        # close the Zip File
-        zipObj.close()
+            self.ccm.close()
+            self.coc.close()
+
+    def __getstate__(self):
+        # Worker processes only need the matching settings, not the open CSV buffers
+        state = self.__dict__.copy()
+        for buffer in ['cfm', 'cfmw', 'ifm', 'ifmw', 'ccm', 'ccmw', 'coc', 'cocw']:
+            del state[buffer]
+        return state
+
+    def generate_zip(self):
+        self.release_zip = f'DB_{date.today()}.zip'
+
+        # Unchanged members are copied from the latest older release
+        if self.previous_release is None:
+            releases = sorted(f for f in glob.glob('DB_????-??-??.zip') if f != self.release_zip)
+            self.previous_release = releases[-1] if releases else None
+        previous = self.previous_release
+
+        release = ReleaseZip(self.release_zip, date.today().timetuple()[:6], previous)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Stream the XML into a temporary file, it's compressed along with the other members
+            with open(f'{tmp}/db.xml', 'wb') as stream, metrics.stage('xml'):
+                self.run(stream)
+            release.add_file("db.xml", f'{tmp}/db.xml')
+
+            # Add multiple files to the zip
+            release.add_bytes("cover_fuzzy_matches.csv", self.cfm.getvalue().encode())
+            release.add_bytes("info_fuzzy_matches.csv", self.ifm.getvalue().encode())
+            release.add_bytes("crc_collisions.csv", self.ccm.getvalue().encode())
+            release.add_bytes("cover_collisions.csv", self.coc.getvalue().encode())
+
+            # Insert only the images used by a game
+            for path in sorted(self.screenshots):
+                release.add_file(path, path)
+
+            with metrics.stage('zip'):
+                release.build()
+
+        logging.info(f"Release: {self.release_zip}, {len(self.screenshots)} covers, "
+                     f"{release.reused} members reused from {previous}")
+
+        if self.delta_package:
+            if previous is None:
+                logging.warning("No previous release to generate the delta package from")
+            else:
+                with metrics.stage('delta_package'):
+                    DeltaPackage(previous, self.release_zip,
+                                 f"{self.release_zip[:-4]}_delta_from_{os.path.basename(previous)}",
+                                 date.today().timetuple()[:6])
 
     def normalize(self, name):
-        nfkd_form = unicodedata.normalize('NFKD', name)
-        name = u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
-
-        norm = os.path.splitext(name)[0]
-
-        norm = norm.lower()
-        substitutions = [(' ii', ' 2'), (' iii', ' 3'), (' iv', '4'), ('!', ''), ('-', ' '), (':', ''), ('\'', ''),
-                         ('~', ' '), (',', ''), ('&', ''), ('+', ''), ('_', ' '), ('/', ''), ('.', ''), ('*', ' ')]
-        for sub in substitutions:
-            norm = norm.replace(sub[0], sub[1])
+        return self.normalizer.normalize(name)
 
-        if '(' in norm:
-            norm = norm.split('(')[0]
-
-        # Remove any duplicated spaces
-        norm = re.sub(r' {2,}', ' ', norm)
-
-        return ''.join([word for word in norm.split() if word not in self.STOP_WORDS])
-
-    def run(self):
+    def run(self, stream):
         # load xsd for xml validation
         xmlschema_doc = etree.parse(
             f"{os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))}/game.xsd")
         xmlschema = etree.XMLSchema(xmlschema_doc)
-        a = etree.Element('{http://tempuri.org/GameDB.xsd}GameDB')
-
-        self.do_roms('Mega Drive - Genesis', '*.md',
-                     'output/Sega - Mega Drive - Genesis/Named_Titles', 'dbs/genesis.json', a)
-        self.do_roms('Master System - Mark III', '*.sms',
-                     'output/Sega - Master System - Mark III/Named_Titles', 'dbs/ms.json', a)
-        self.do_roms('32X', '*.32x', 'output/Sega - 32X/Named_Titles', 'dbs/32x.json', a)
-        self.do_roms('SG-1000', '*.sg', 'output/Sega - SG-1000/Named_Titles', 'dbs/sg1000.json', a)
-        self.do_roms('Sega - Mega CD & Sega CD - Datfile (MegaSD).dat', '*.cue', 'output/Sega - Mega CD & Sega CD/Named_Titles', 'dbs/cd.json', a)
-
-        # Insert genres at the end of the XML
-        l1 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k1 = etree.SubElement(l1, '{http://tempuri.org/GameDB.xsd}Genre')
-        k1.text = str(1)
-        k2 = etree.SubElement(l1, '{http://tempuri.org/GameDB.xsd}Name')
-        k2.text = 'Shooter'
-
-        l2 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k3 = etree.SubElement(l2, '{http://tempuri.org/GameDB.xsd}Genre')
-        k3.text = str(2)
-        k4 = etree.SubElement(l2, '{http://tempuri.org/GameDB.xsd}Name')
-        k4.text = 'Action'
-
-        l3 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k5 = etree.SubElement(l3, '{http://tempuri.org/GameDB.xsd}Genre')
-        k5.text = str(3)
-        k6 = etree.SubElement(l3, '{http://tempuri.org/GameDB.xsd}Name')
-        k6.text = 'Sports'
-
-        l4 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k7 = etree.SubElement(l4, '{http://tempuri.org/GameDB.xsd}Genre')
-        k7.text = str(4)
-        k8 = etree.SubElement(l4, '{http://tempuri.org/GameDB.xsd}Name')
-        k8.text = 'Misc'
-
-        l5 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k9 = etree.SubElement(l5, '{http://tempuri.org/GameDB.xsd}Genre')
-        k9.text = str(5)
-        k10 = etree.SubElement(l5, '{http://tempuri.org/GameDB.xsd}Name')
-        k10.text = 'Casino'
-
-        l6 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k11 = etree.SubElement(l6, '{http://tempuri.org/GameDB.xsd}Genre')
-        k11.text = str(6)
-        k12 = etree.SubElement(l6, '{http://tempuri.org/GameDB.xsd}Name')
-        k12.text = 'Driving'
-
-        l7 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k11 = etree.SubElement(l7, '{http://tempuri.org/GameDB.xsd}Genre')
-        k11.text = str(7)
-        k12 = etree.SubElement(l7, '{http://tempuri.org/GameDB.xsd}Name')
-        k12.text = 'Platform'
-
-        l8 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k13 = etree.SubElement(l8, '{http://tempuri.org/GameDB.xsd}Genre')
-        k13.text = str(8)
-        k14 = etree.SubElement(l8, '{http://tempuri.org/GameDB.xsd}Name')
-        k14.text = 'Puzzle'
-
-        l9 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k15 = etree.SubElement(l9, '{http://tempuri.org/GameDB.xsd}Genre')
-        k15.text = str(9)
-        k16 = etree.SubElement(l9, '{http://tempuri.org/GameDB.xsd}Name')
-        k16.text = 'Boxing'
-
-        l10 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k17 = etree.SubElement(l10, '{http://tempuri.org/GameDB.xsd}Genre')
-        k17.text = str(10)
-        k18 = etree.SubElement(l10, '{http://tempuri.org/GameDB.xsd}Name')
-        k18.text = 'Wrestling'
-
-        l11 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k19 = etree.SubElement(l11, '{http://tempuri.org/GameDB.xsd}Genre')
-        k19.text = str(11)
-        k20 = etree.SubElement(l11, '{http://tempuri.org/GameDB.xsd}Name')
-        k20.text = 'Strategy'
-
-        l12 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k21 = etree.SubElement(l12, '{http://tempuri.org/GameDB.xsd}Genre')
-        k21.text = str(12)
-        k22 = etree.SubElement(l12, '{http://tempuri.org/GameDB.xsd}Name')
-        k22.text = 'Soccer'
-
-        l13 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k23 = etree.SubElement(l13, '{http://tempuri.org/GameDB.xsd}Genre')
-        k23.text = str(13)
-        k24 = etree.SubElement(l13, '{http://tempuri.org/GameDB.xsd}Name')
-        k24.text = 'Golf'
-
-        l14 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k25 = etree.SubElement(l14, '{http://tempuri.org/GameDB.xsd}Genre')
-        k25.text = str(14)
-        k26 = etree.SubElement(l14, '{http://tempuri.org/GameDB.xsd}Name')
-        k26.text = 'Beat\'Em-Up'
-
-        l15 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k27 = etree.SubElement(l15, '{http://tempuri.org/GameDB.xsd}Genre')
-        k27.text = str(15)
-        k28 = etree.SubElement(l15, '{http://tempuri.org/GameDB.xsd}Name')
-        k28.text = 'Baseball'
-
-        l16 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k29 = etree.SubElement(l16, '{http://tempuri.org/GameDB.xsd}Genre')
-        k29.text = str(16)
-        k30 = etree.SubElement(l16, '{http://tempuri.org/GameDB.xsd}Name')
-        k30.text = 'Mahjong'
-
-        l17 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k31 = etree.SubElement(l17, '{http://tempuri.org/GameDB.xsd}Genre')
-        k31.text = str(17)
-        k32 = etree.SubElement(l17, '{http://tempuri.org/GameDB.xsd}Name')
-        k32.text = 'Board'
-
-        l18 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k33 = etree.SubElement(l18, '{http://tempuri.org/GameDB.xsd}Genre')
-        k33.text = str(18)
-        k34 = etree.SubElement(l18, '{http://tempuri.org/GameDB.xsd}Name')
-        k34.text = 'Tennis'
-
-        l19 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k35 = etree.SubElement(l19, '{http://tempuri.org/GameDB.xsd}Genre')
-        k35.text = str(19)
-        k36 = etree.SubElement(l19, '{http://tempuri.org/GameDB.xsd}Name')
-        k36.text = 'Fighter'
-
-        l20 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k37 = etree.SubElement(l20, '{http://tempuri.org/GameDB.xsd}Genre')
-        k37.text = str(20)
-        k38 = etree.SubElement(l20, '{http://tempuri.org/GameDB.xsd}Name')
-        k38.text = 'Horse Racing'
-
-        l21 = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Genre')
-        k39 = etree.SubElement(l21, '{http://tempuri.org/GameDB.xsd}Genre')
-        k39.text = str(21)
-        k40 = etree.SubElement(l21, '{http://tempuri.org/GameDB.xsd}Name')
-        k40.text = 'Other'
 
-        # Validate schema - Exception thrown if not valid
-        try:
-            xmlschema.assertValid(etree.ElementTree(a))
-        except Exception as e:
-            print(e)
-            pass
+        with GameDBWriter(stream, xmlschema) as writer:
+            # Match every platform in its own process, but add them to the XML in order
+            # so the game IDs and the CRC de-duplication don't depend on which one finishes first
+            with ProcessPoolExecutor(max_workers=len(self.PLATFORMS)) as executor:
+                results = [executor.submit(self.do_roms, *platform) for platform in self.PLATFORMS]
+                for platform, result in zip(self.PLATFORMS, results):
+                    self.add_roms(platform[0], platform[1], result.result(), writer)
 
-        # Save XML with indentation
-        # Return DB in XML as string
-        return minidom.parseString(etree.tostring(a)).toprettyxml(indent="    ")
+            # Insert genres at the end of the XML
+            for i, genre in enumerate(self.GENRES):
+                writer.write_record('Genre', [('Genre', str(i + 1)), ('Name', genre)])
+
+    def do_roms(self, datfile_name, rom_ext, cover_path, db_path):
+        """
+        Load, normalize and fuzzy match all ROMs of a platform
+
+        Runs in a worker process, so it only returns plain data that add_roms
+        turns into XML elements
+        """
+        start_time = time.perf_counter()
 
-    def do_roms(self, datfile_name, rom_ext, cover_path, db_path, a):
         # Load all roms with full path
         roms = []
         roms_hash = {}  # store rom name with corresponding hash
@@ -260,60 +263,60 @@ class XMLGenerator():
             roms.append(t.attrib.get('name'))
             roms_hash[t.attrib.get('name')] = t.attrib.get('crc')
 
-        # Load game covers
-        game_covers_l = []
-        for x in os.walk(f'{cover_path}'):
-            for y in glob.glob(os.path.join(x[0], '*.png')):
-                game_covers_l.append(y)
-        game_covers = {}
-        # Normalize cover name (some will be overwritten by the normalization)
-        for d in game_covers_l:
-            game_covers[self.normalize(os.path.basename(d))] = d
+        # Load game covers, only the folders that changed since the last run are read again
+        cover_index = CoverIndex(cover_path, self.normalizer, f"cache/covers/{os.path.basename(db_path)}")
+        cover_index.update()
+        cover_index.save()
+        logging.info(f"{datfile_name}: {cover_index.listed} cover folders listed, {cover_index.hashed} covers hashed")
+        # Normalized cover name -> path (some will be overwritten by the normalization)
+        game_covers, cover_collisions = cover_index.covers()
 
         # Load IGDB games lists
-        # Use downloader.py
-        games_list = []
-        with open(db_path) as f:
-            games_list = json.load(f)
+        games_list, db_game_of = self.load_games(db_path)
 
-        # Normalize game names
-        new_games_list = {}
-        for game in games_list:
-            new_games_list[self.normalize(game['name'])] = game
-            # Add alternate names to list too (copies the whole object)
-            if 'alternative_names' in game:
-                for alt_name in game['alternative_names']:
-                    new_games_list[self.normalize(alt_name)] = game
-        games_list = new_games_list
+        # Candidate indexes are only built if some title is missing from the cache
+        games_matcher = FuzzyMatcher(games_list.keys(), self.check_parity)
+        covers_matcher = FuzzyMatcher(game_covers.keys(), self.check_parity)
 
         # Build dict of normalized game title -> rom paths
         res = defaultdict(list)
-        for f in roms:
-            title = os.path.basename(f)
-            filename = self.normalize(title)
+        for f, filename in zip(roms, self.normalizer.normalize_many([os.path.basename(f) for f in roms])):
             res[filename].append(f)
 
-        # Search for coincidences and build xml
+        titles = [filename for filename in res.keys() if '[bios]' not in filename]
+
+        # The cache is still written with --no-cache, so the next run can use it
+        cache = MatchCache(f"cache/matches/{os.path.basename(db_path)}")
+        restored = 0
+        if self.use_cache:
+            restored = cache.restore('games', games_matcher, titles)
+            restored += cache.restore('covers', covers_matcher, titles)
+            logging.info(f"{datfile_name}: restored {restored}/{2 * len(titles)} fuzzy matches from the cache")
+
+        if self.batch:
+            games_matcher.extract_many(titles)
+            covers_matcher.extract_many(titles)
+
+        # Search for coincidences
         found_db = 0
         found_covers = 0
+        games = []
+        info_matches = []
+        cover_matches = []
 
         for filename, paths in res.items():
             # Skip any BIOS files
             if '[bios]' in filename:
                 continue
 
-            self.COUNTER += 1
-
-            b = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}Game')
-
-            c = etree.SubElement(b, '{http://tempuri.org/GameDB.xsd}ID')
-            c.text = str(self.COUNTER)
-
-            d = etree.SubElement(b, '{http://tempuri.org/GameDB.xsd}Name')
-            d.text = os.path.basename(paths[0].split('(')[0]) + f'({rom_ext[2:]})'
+            game = {
+                'name': os.path.basename(paths[0].split('(')[0]) + f'({rom_ext[2:]})',
+                'roms': [(p, roms_hash[p]) for p in paths]
+            }
+            games.append(game)
 
             # Fuzzy match
-            match = process.extractOne(filename, games_list.keys())
+            match = games_matcher.extract_one(filename)
             score = 90
             if match[0][-1].isdigit() or filename[-1].isdigit():
                 score = 100
@@ -321,105 +324,150 @@ class XMLGenerator():
                 score = 100
 
             if match[1] >= score:
-                game = games_list[match[0]]
+                db_game = db_game_of(games_list[match[0]])
 
                 found_db += 1
 
                 if match[1] != 100:
-                    self.ifmw.writerow({'ROM': paths[0], 'DB Entry': games_list[match[0]]["name"], "Score": match[1]})
-
-                # Year must be inserted before the genre
-                if 'release_dates' in game and len(game['release_dates']) > 0 and 'y' in game['release_dates'][0]:
-                    e2 = etree.SubElement(b, '{http://tempuri.org/GameDB.xsd}Year')
-                    e2.text = str(game['release_dates'][0]['y'])
-
-                if 'genres' in game and len(game['genres']) != 0:
-                    e = etree.SubElement(b, '{http://tempuri.org/GameDB.xsd}Genre')
-                    g = game['genres'][0]
-                    if g == 'Shooter':
-                        e.text = str(1)
-                    elif g == 'Action':
-                        e.text = str(2)
-                    elif g == 'Sports':
-                        e.text = str(3)
-                    elif g == 'Misc':
-                        e.text = str(4)
-                    elif g == 'Casino':
-                        e.text = str(5)
-                    elif g == 'Driving':
-                        e.text = str(6)
-                    elif g == 'Platform':
-                        e.text = str(7)
-                    elif g == 'Puzzle':
-                        e.text = str(8)
-                    elif g == 'Boxing':
-                        e.text = str(9)
-                    elif g == 'Wrestling':
-                        e.text = str(10)
-                    elif g == 'Strategy':
-                        e.text = str(11)
-                    elif g == 'Soccer':
-                        e.text = str(12)
-                    elif g == 'Golf':
-                        e.text = str(13)
-                    elif g == 'Beat\'Em-Up':
-                        e.text = str(14)
-                    elif g == 'Baseball':
-                        e.text = str(15)
-                    elif g == 'Mahjong':
-                        e.text = str(16)
-                    elif g == 'Board':
-                        e.text = str(17)
-                    elif g == 'Tennis':
-                        e.text = str(18)
-                    elif g == 'Fighter':
-                        e.text = str(19)
-                    elif g == 'Horse Racing':
-                        e.text = str(20)
-                    elif g == 'Other':
-                        e.text = str(21)
-                    else:  # Wrong genre
-                        print(f'ABORTING - WRONG GENRE {g}')
-                        exit()
+                    info_matches.append({'ROM': paths[0], 'DB Entry': db_game["name"], "Score": match[1]})
+
+                if 'release_dates' in db_game and len(db_game['release_dates']) > 0 and 'y' in db_game['release_dates'][0]:
+                    game['year'] = str(db_game['release_dates'][0]['y'])
+
+                if 'genres' in db_game and len(db_game['genres']) != 0:
+                    game['genre'] = db_game['genres'][0]
 
             # Fuzzy match
-            match = process.extractOne(filename, game_covers.keys())
+            match = covers_matcher.extract_one(filename)
             if match[1] >= score:
 
                 if match[1] != 100:
-                    self.cfmw.writerow({"ROM": paths[0], "Cover": game_covers[match[0]], "Score": match[1]})
+                    cover_matches.append({"ROM": paths[0], "Cover": game_covers[match[0]], "Score": match[1]})
 
-                game_cover = game_covers[match[0]]
-                f = etree.SubElement(b, '{http://tempuri.org/GameDB.xsd}Screenshot')
-                f.text = game_cover.replace('/mnt/c', 'c:\\').replace('/', '\\\\')
                 found_covers += 1
+                game['cover'] = game_covers[match[0]]
+                game['screenshot'] = game_covers[match[0]].replace('/mnt/c', 'c:\\').replace('/', '\\\\')
+
+        if self.check_parity:
+            mismatches = games_matcher.mismatches + covers_matcher.mismatches
+            if mismatches != 0:
+                raise Exception(f"{mismatches} indexed fuzzy matches differ from the linear scan")
+
+        cache.store('games', games_matcher)
+        cache.store('covers', covers_matcher)
+        cache.save()
+
+        return {
+            'games': games,
+            'info_matches': info_matches,
+            'cover_matches': cover_matches,
+            'cover_collisions': [{"Cover Key": key, "Cover": cover, "Dropped Cover": dropped, "Same Image": same}
+                                 for key, cover, dropped, same in cover_collisions],
+            'roms': len(res.keys()),
+            'found_db': found_db,
+            'found_covers': found_covers,
+            'db_entries': len(games_list.keys()),
+            'covers': len(game_covers.keys()),
+            'comparisons': games_matcher.comparisons + covers_matcher.comparisons,
+            'match_cache_hits': restored,
+            'cover_folders_listed': cover_index.listed,
+            'covers_hashed': cover_index.hashed,
+            'seconds': time.perf_counter() - start_time
+        }
+
+    def load_games(self, db_path):
+        """
+        Normalized IGDB name -> game, and a function that returns the game record of a value
 
-            # Calulcate hash for all rom variations
-            for p in paths:
-                crc_hash = roms_hash[p]
-                if crc_hash not in self.hashes:
-                    self.hashes.append(crc_hash)
-                    g = etree.SubElement(a, '{http://tempuri.org/GameDB.xsd}GameCk')
+        Uses the SQLite store written by IGDBDownloader if it has the platform, so only the matched
+        games are read, otherwise loads and normalizes the whole JSON dump
+        """
+        store = IGDBStore()
+        dump = os.path.basename(db_path)
+        if store.has_dump(dump):
+            return store.candidates(dump, self.normalizer), lambda game_id: store.game(dump, game_id)
 
-                    h = etree.SubElement(g, '{http://tempuri.org/GameDB.xsd}Checksum')
-                    h.text = crc_hash.zfill(8)
+        # Use downloader.py
+        games_list = []
+        with open(db_path) as f:
+            games_list = json.load(f)
 
-                    i = etree.SubElement(g, '{http://tempuri.org/GameDB.xsd}GameID')
-                    i.text = str(self.COUNTER)
+        # Normalize game names
+        names = []
+        for game in games_list:
+            names.append((game['name'], game))
+            # Add alternate names to list too (copies the whole object)
+            if 'alternative_names' in game:
+                for alt_name in game['alternative_names']:
+                    names.append((alt_name, game))
+        games_list = dict(zip(self.normalizer.normalize_many([name for name, game in names]),
+                              [game for name, game in names]))
+
+        return games_list, lambda game: game
 
-                title = os.path.basename(p)
-                if filename in game_covers.keys():
-                    cover = game_covers[filename]
+    def add_roms(self, datfile_name, rom_ext, result, writer):
+        """
+        Add the matched games of a platform to the XML, in the same order they were found
+        """
+        collisions = 0
+
+        for row in result['info_matches']:
+            self.ifmw.writerow(row)
+        for row in result['cover_matches']:
+            self.cfmw.writerow(row)
+        for row in result['cover_collisions']:
+            self.cocw.writerow(row)
+
+        for game in result['games']:
+            self.COUNTER += 1
+
+            fields = [('ID', str(self.COUNTER)), ('Name', game['name'])]
+
+            # Year must be inserted before the genre
+            if 'year' in game:
+                fields.append(('Year', game['year']))
+
+            if 'genre' in game:
+                if game['genre'] not in self.GENRES:  # Wrong genre
+                    print(f'ABORTING - WRONG GENRE {game["genre"]}')
+                    exit()
+                fields.append(('Genre', str(self.GENRES.index(game['genre']) + 1)))
+
+            if 'screenshot' in game:
+                fields.append(('Screenshot', game['screenshot']))
+                self.screenshots.add(game['cover'])
+
+            writer.write_record('Game', fields)
+
+            # Calulcate hash for all rom variations
+            for rom, crc_hash in game['roms']:
+                owner = self.crcs.add(crc_hash, rom, datfile_name)
+                if owner is None:
+                    writer.write_record('GameCk', [('Checksum', crc_hash.zfill(8)), ('GameID', str(self.COUNTER))])
                 else:
-                    cover = None
+                    collisions += 1
+                    self.ccmw.writerow({"CRC": crc_hash.zfill(8), "ROM": owner[0], "Platform": owner[1],
+                                        "Dropped ROM": rom, "Dropped Platform": datfile_name})
 
         # Print stats
         logging.info(f"ROM type: {rom_ext}")
-        logging.info(f"Total ROMs: {len(res.keys())}")
-        logging.info(f"IGDB Matches: {found_db}/{len(games_list.keys())}")
-        logging.info(f"Cover matches: {found_covers}/{len(game_covers.keys())}\n")
-
-        self.release_md += f"| {datfile_name} | {found_db} | {found_covers} |%0A"
+        logging.info(f"Total ROMs: {result['roms']}")
+        logging.info(f"IGDB Matches: {result['found_db']}/{result['db_entries']}")
+        logging.info(f"Cover matches: {result['found_covers']}/{result['covers']}")
+        logging.info(f"CRC collisions: {collisions}")
+        logging.info(f"Cover collisions: {len(result['cover_collisions'])}")
+        logging.info(f"Fuzzy comparisons: {result['comparisons']}\n")
+
+        # Matched in a worker process, only its totals come back
+        metrics.record(datfile_name, result['seconds'])
+        for key, counter in [('roms', 'roms'), ('found_db', 'igdb_matches'), ('found_covers', 'cover_matches'),
+                             ('db_entries', 'igdb_entries'), ('covers', 'covers'), ('comparisons', 'fuzzy_comparisons'),
+                             ('match_cache_hits', 'match_cache_hits'), ('cover_folders_listed', 'cover_folders_listed'),
+                             ('covers_hashed', 'covers_hashed')]:
+            metrics.count(counter, result[key])
+        metrics.count('games', len(result['games']))
+
+        self.release_md += f"| {datfile_name} | {result['found_db']} | {result['found_covers']} |%0A"
 
     @staticmethod
     def crc(fileName):
@@ -430,14 +478,18 @@ class XMLGenerator():
 
         # cue + bin
         if ext == '.cue':
+            bin_file = None
             with open(fileName) as f:
                 # Get first bin file from first or second cue sheet line
                 for i, line in enumerate(f):
                     if 'CATALOG' in line:
                         continue
                     else:
-                        bin_file = line[6:-9]
+                        # FILE "name.bin" BINARY
+                        bin_file = line.rstrip('\r\n')[6:-8]
                         break
+            if bin_file is None:
+                raise ValueError(f"{fileName} has no FILE entry")
 
             # Read first 2KB of first bin file of CUE sheet
             fileName = f'{os.path.dirname(fileName)}/{bin_file}'
@@ -450,7 +502,11 @@ class XMLGenerator():
 
         # ROMs
         else:
+            # Fixed size reads into the same buffer
             prev = 0
-            for eachLine in open(fileName, "rb"):
-                prev = zlib.crc32(eachLine, prev)
+            buffer = bytearray(XMLGenerator.CRC_BUFFER_SIZE)
+            view = memoryview(buffer)
+            with open(fileName, 'rb', buffering=0) as f:
+                while size := f.readinto(buffer):
+                    prev = zlib.crc32(view[:size], prev)
             return "%X" % (prev & 0xFFFFFFFF)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+from datetime import datetime
+from io import StringIO
+from csv import DictWriter
+from redumpFiller import cal_crc
+from ReleaseZip import ReleaseZip
+from XMLBuilder import CRCRegistry, GameDBWriter, XMLGenerator
+from lxml import etree
+from Metrics import Metrics
+from Normalizer import Normalizer
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+import zlib
+
+# Today's Genesis size, scale 1
+GENESIS_ROMS = 2600
+GENESIS_GAMES = 1800
+GENESIS_COVERS = 1300
+
+# ROM files and Mega CD ZIP files hashed per scale, and their size
+CRC_FILES = 10
+CRC_FILE_SIZE = 128 * 1024
+CD_ZIPS = 5
+CD_BIN_SIZE = 256 * 1024
+
+WORDS = ['Sonic', 'Streets', 'Rage', 'Golden', 'Axe', 'Shinobi', 'Phantasy', 'Star', 'Thunder', 'Force', 'Gunstar',
+         'Heroes', 'Ecco', 'Dolphin', 'Castle', 'Illusion', 'World', 'Super', 'Monaco', 'Prix', 'Shadow', 'Dancer',
+         'Revenge', 'Alien', 'Soldier', 'Landstalker', 'Road', 'Rash', 'Vectorman', 'Comix', 'Zone', 'Dragon',
+         'Fury', 'Strider', 'Contra', 'Hard', 'Corps', 'Knuckles', 'Chaotix', 'Toejam', 'Earl', 'Desert', 'Strike',
+         'Jungle', 'Urban', 'Ghouls', 'Ghosts', 'Kid', 'Chameleon', 'Mega', 'Turrican', 'Batman', 'Flashback',
+         'Ristar', 'Wonder', 'Boy', 'Columns', 'Eternal', 'Champions', 'Sword', 'Vermilion', 'Herzog', 'Zwei']
+REGIONS = ['USA', 'Europe', 'Japan', 'USA, Europe', 'Brazil', 'Korea', 'World']
+TAGS = ['', '', '', ' (Rev 1)', ' (Beta)', ' (Proto)', ' (Alt 1)']
+
+
+class SyntheticGenerator(XMLGenerator):
+    # Only the Genesis is generated
+    PLATFORMS = XMLGenerator.PLATFORMS[:1]
+
+
+def title(rng):
+    words = rng.sample(WORDS, rng.randint(1, 4))
+    name = ' '.join(words)
+    if rng.random() < 0.2:
+        name += f' {rng.randint(2, 4)}'
+    if rng.random() < 0.2:
+        name += f' - {" ".join(rng.sample(WORDS, 2))}'
+    return name
+
+
+def png(rng):
+    """
+    Small but valid 64x40 grayscale PNG with random content
+    """
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    rows = b''.join(b'\0' + bytes(rng.getrandbits(8) for _ in range(64)) for _ in range(40))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 64, 40, 8, 0, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+def generate(scale, seed=0):
+    """
+    Synthetic DAT, IGDB dump, covers, ROMs and Mega CD ZIP files in the current folder
+
+    Returns the ROM, IGDB and cover names, the ROM files and the ZIP files
+    """
+    rng = random.Random(seed)
+
+    # Titles made only of stop words would normalize to nothing
+    normalizer = Normalizer()
+    titles = []
+    while len(titles) < GENESIS_GAMES * scale:
+        name = title(rng)
+        if normalizer.normalize(name):
+            titles.append(name)
+    dat_name, rom_ext, cover_path, db_path = SyntheticGenerator.PLATFORMS[0]
+
+    # No-Intro style DAT, several ROMs per title
+    os.makedirs('dats')
+    with open(f'dats/Sega - {dat_name} (20240101-000000).dat', 'w') as f:
+        f.write('<?xml version="1.0"?>\n<datafile>\n')
+        names = set()
+        while len(names) < GENESIS_ROMS * scale:
+            name = f'{rng.choice(titles)} ({rng.choice(REGIONS)}){rng.choice(TAGS)}'
+            if name in names:
+                continue
+            names.add(name)
+            crc = '%08X' % rng.getrandbits(32)
+            f.write(f'  <game name="{name}"><rom name="{name}{rom_ext[1:]}" size="1" crc="{crc}"/></game>\n')
+        f.write('</datafile>\n')
+
+    # IGDB dump in the format written by IGDBDownloader
+    games = []
+    for i, name in enumerate(titles):
+        game = {'id': i, 'name': name}
+        if rng.random() < 0.3:
+            game['alternative_names'] = [name.upper(), name.replace(' ', ': ', 1)]
+        game['release_dates'] = [{'y': rng.randint(1988, 1998), 'region': rng.choice(['europe', 'north_america'])}]
+        game['genres'] = [rng.choice(XMLGenerator.GENRES)]
+        games.append(game)
+    os.makedirs('dbs')
+    with open(db_path, 'w') as f:
+        json.dump(games, f)
+
+    # Covers, named like libretro-thumbnails
+    os.makedirs(cover_path)
+    for name in rng.sample(titles, min(len(titles), GENESIS_COVERS * scale)):
+        with open(f'{cover_path}/{name.replace("/", "_")}.png', 'wb') as f:
+            f.write(png(rng))
+
+    # Plain ROMs for XMLGenerator.crc
+    os.makedirs('roms')
+    roms = []
+    for i in range(CRC_FILES * scale):
+        roms.append(f'roms/{i}.md')
+        with open(roms[-1], 'wb') as f:
+            f.write(rng.randbytes(CRC_FILE_SIZE))
+
+    # Mega CD ZIP files for redumpFiller.cal_crc
+    os.makedirs('cd')
+    zips = []
+    for i in range(CD_ZIPS * scale):
+        zips.append(f'cd/{i}.zip')
+        with zipfile.ZipFile(zips[-1], 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr(f'Game {i}.cue', f'FILE "Game {i} (Track 1).bin" BINARY\r\n  TRACK 01 MODE1/2352\r\n')
+            z.writestr(f'Game {i} (Track 1).bin', rng.randbytes(CD_BIN_SIZE))
+
+    return sorted(names) + titles + os.listdir(cover_path), roms, zips
+
+
+def measure(name, scale, items, function, repeat):
+    """
+    Best time of `repeat` runs, then one more run to trace the peak Python memory
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {'benchmark': name, 'scale': scale, 'items': items, 'seconds': min(times),
+              'peak_memory': peak, 'max_rss_kb': Metrics.max_rss()}
+    logging.info(f"{name} x{scale}: {items} items in {min(times):.3f}s, peak {peak / 1024 / 1024:.1f} MiB")
+    return result
+
+
+def serialize(generator, result, stream):
+    """
+    Write the records of a do_roms result like XMLGenerator.run does
+    """
+    # Fresh reports and counters, the generator's were closed when it finished
+    for writer in ['cfmw', 'ifmw', 'ccmw', 'cocw']:
+        setattr(generator, writer, DictWriter(StringIO(), fieldnames=getattr(generator, writer).fieldnames))
+    generator.COUNTER = 0
+    generator.crcs = CRCRegistry()
+    generator.screenshots = set()
+
+    xmlschema = etree.XMLSchema(etree.parse(f"{os.path.dirname(os.path.abspath(__file__))}/game.xsd"))
+    stream.seek(0)
+    stream.truncate()
+    with GameDBWriter(stream, xmlschema) as writer:
+        generator.add_roms(generator.PLATFORMS[0][0], generator.PLATFORMS[0][1], result, writer)
+
+
+def release(generator, db_xml):
+    """
+    Package db.xml and the used covers like XMLGenerator.generate_zip does
+    """
+    release_zip = ReleaseZip('benchmark.zip', (2024, 1, 1, 0, 0, 0))
+    release_zip.add_file('db.xml', db_xml)
+    for path in sorted(generator.screenshots):
+        release_zip.add_file(path, path)
+    release_zip.build()
+
+
+def run_scale(scale, repeat):
+    results = []
+    names, roms, zips = generate(scale)
+    genesis = SyntheticGenerator.PLATFORMS[0]
+
+    # Generate the DB once, its settings are reused by the stages below
+    holder = {}
+
+    def generate_db():
+        holder['generator'] = SyntheticGenerator(use_cache=False)
+    results.append(measure('generate_zip', scale, GENESIS_ROMS * scale, generate_db, repeat))
+    generator = holder['generator']
+
+    def normalize():
+        generator.normalizer.normalize.cache_clear()
+        for name in names:
+            generator.normalize(name)
+    results.append(measure('normalize', scale, len(names), normalize, repeat))
+
+    def do_roms():
+        generator.normalizer.normalize.cache_clear()
+        holder['result'] = generator.do_roms(*genesis)
+    results.append(measure('do_roms', scale, GENESIS_ROMS * scale, do_roms, repeat))
+    with open('db.xml', 'w+b') as stream:
+        results.append(measure('serialize', scale, len(holder['result']['games']),
+                               lambda: serialize(generator, holder['result'], stream), repeat))
+
+    results.append(measure('release_zip', scale, len(generator.screenshots), lambda: release(generator, 'db.xml'),
+                           repeat))
+
+    results.append(measure('crc', scale, len(roms), lambda: [XMLGenerator.crc(rom) for rom in roms], repeat))
+
+    def cd_crcs():
+        for path in zips:
+            with open(path, 'rb') as f:
+                cal_crc(f)
+    results.append(measure('cal_crc', scale, len(zips), cd_crcs, repeat))
+
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results):
+    """
+    Print the time and memory of every benchmark relative to a previous results file
+    """
+    with open(previous) as f:
+        old = {(r['benchmark'], r['scale']): r for r in json.load(f)['results']}
+
+    print(f"{'Benchmark':<16}{'Scale':>6}{'Time':>10}{'Memory':>10}")
+    for r in results:
+        o = old.get((r['benchmark'], r['scale']))
+        if o is None:
+            continue
+        print(f"{r['benchmark']:<16}{r['scale']:>6}{r['seconds'] / o['seconds']:>9.2f}x"
+              f"{r['peak_memory'] / max(o['peak_memory'], 1):>9.2f}x")
+
+
+def main():
+    FORMAT = '%(asctime)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+
+    parser = argparse.ArgumentParser(
+        description="Time the generator stages on synthetic data at multiples of today's Genesis size, offline")
+    parser.add_argument("--scales", nargs='+', type=int, default=[1],
+                        help="Data sizes to run, 1 is today's Genesis, fuzzy matching grows faster than linearly")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark, the fastest one is kept")
+    parser.add_argument("--output", default='benchmark.json', help="JSON file the results are written to")
+    parser.add_argument("--compare", nargs=1, required=False, help="Previous results file to compare with")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    previous = os.path.abspath(args.compare[0]) if args.compare else None
+
+    results = []
+    cwd = os.getcwd()
+    for scale in args.scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                results += run_scale(scale, args.repeat)
+            finally:
+                os.chdir(cwd)
+
+    with open(output, 'w') as f:
+        json.dump({'commit': commit(), 'date': datetime.now().isoformat(timespec='seconds'),
+                   'python': sys.version.split()[0], 'machine': platform.machine(), 'cpus': os.cpu_count(),
+                   'results': results}, f, indent=4)
+    logging.info(f"Results written to {output}")
+
+    if previous is not None:
+        compare(previous, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,111 @@
-from io import BytesIO
+from HTTPCache import http_cache
+from Metrics import metrics
+from requests.structures import CaseInsensitiveDict
 from selenium import webdriver
 from time import sleep
 import hashlib
+import json
 import logging
 import os
 import re
-import requests
 import zipfile
 
 
+# DAT file name -> SHA-256 of every DAT extracted, and the DATs extracted from each source
+MANIFEST = './cache/dats.json'
+
+
+def fileHash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def loadManifest():
+    """
+    Manifest of the last extracted DATs, later stages can compare it to know if their inputs changed
+    """
+    if not os.path.exists(MANIFEST):
+        return {'sources': {}, 'dats': {}}
+    with open(MANIFEST) as f:
+        return json.load(f)
+
+
+def upToDate(manifest, source):
+    """
+    Whether the DATs extracted from a source are still in ./dats unchanged
+    """
+    if source not in manifest['sources']:
+        return False
+    for dat in manifest['sources'][source]:
+        path = os.path.join('./dats', dat)
+        if not os.path.exists(path) or fileHash(path) != manifest['dats'].get(dat):
+            return False
+    return True
+
+
+def extractDATs(manifest, source, archive, members):
+    """
+    Extract only the given members of a DAT archive and record their hashes
+    """
+    for f in members:
+        archive.extract(f, "./dats/")
+
+    manifest['sources'][source] = members
+    for f in members:
+        manifest['dats'][f] = fileHash(os.path.join('./dats', f))
+
+    os.makedirs(os.path.dirname(MANIFEST), exist_ok=True)
+    with open(f'{MANIFEST}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(f'{MANIFEST}.tmp', MANIFEST)
+
+
 def downloadNoIntro():
     logging.info("Downloading No-Intro DATs")
 
-    r = requests.get('https://github.com/hugo19941994/auto-datfile-generator/releases/latest/download/no-intro.zip')
-    r.raise_for_status()
+    # Streamed to disk and only downloaded again if the release changed
+    entry, path, modified = http_cache.download(
+        'https://github.com/hugo19941994/auto-datfile-generator/releases/latest/download/no-intro.zip')
 
-    # Load zip file into memory
-    zipdata = BytesIO()
-    zipdata.write(r.content)
-    archive = zipfile.ZipFile(zipdata)
+    manifest = loadManifest()
+    if not modified and upToDate(manifest, 'no-intro'):
+        logging.info("No-Intro DATs didn't change")
+        return
 
     # Extract relevent DAT files
     dats = ["32X", "Master System - Mark III", "Mega Drive - Genesis", "SG-1000"]
-    for f in archive.namelist():
-        if any(platform in f for platform in dats):
-            archive.extract(f, "./dats/")
+    with zipfile.ZipFile(path) as archive:
+        members = [f for f in archive.namelist() if any(platform in f for platform in dats)]
+        extractDATs(manifest, 'no-intro', archive, members)
 
 
 def downloadRedump():
     logging.info("Downloading Redump Sega CD DAT")
 
     # Download redump Sega-CD datfile
-    r = requests.get("http://redump.org/datfile/mcd/")
-    r.raise_for_status()
+    entry, path, modified = http_cache.download("http://redump.org/datfile/mcd/")
 
-    # Load zip file into memory
-    zipdata = BytesIO()
-    zipdata.write(r.content)
-    archive = zipfile.ZipFile(zipdata)
+    d = CaseInsensitiveDict(entry['headers'])['content-disposition']
+    fname = re.findall("filename=(.+)", d)[0]
 
-    # Extract Sega CD datfile
-    archive.extractall("./dats/")
+    manifest = loadManifest()
+    if not modified and upToDate(manifest, 'redump'):
+        logging.info("Redump Sega CD DAT didn't change")
+    else:
+        # Extract Sega CD datfile
+        with zipfile.ZipFile(path) as archive:
+            extractDATs(manifest, 'redump', archive, archive.namelist())
 
-    d = r.headers['content-disposition']
-    fname = re.findall("filename=(.+)", d)[0]
     return fname[1:-5] + ".dat"
 
 
 def downloadSmokemonsterCD():
     logging.info("Downloading Sega CD SmokeMonster DB")
-    r = requests.get(
-        "https://raw.githubusercontent.com/SmokeMonsterPacks/EverDrive-Packs-Lists-Database/master/EverDrive%20Pack%20SMDBs/MegaSD%20SMDB.txt")
+    r = http_cache.request(
+        "GET", "https://raw.githubusercontent.com/SmokeMonsterPacks/EverDrive-Packs-Lists-Database/master/EverDrive%20Pack%20SMDBs/MegaSD%20SMDB.txt")
     r.raise_for_status()
 
     with open('./dats/MegaSD SMDB.txt', 'w') as f:
@@ -63,7 +118,8 @@ def checkDATs():
 
 
 def downloadDATs():
-    downloadNoIntro()
+    with metrics.stage('no-intro'):
+        downloadNoIntro()
     # Redump CRCs don't correspond to the MegaSD's expected CRC values
     # use --update-custom-dat to generate the expected CRC values
     # downloadRedump()
@@ -3,10 +3,16 @@
 import argparse
 import logging
 import sys
+from datetime import date
 from datDownloader import downloadDATs
+from HTTPCache import http_cache
+from AsyncIGDBDownloader import AsyncIGDBDownloader
+from CoverProcessor import CoverProcessor
 from IGDBDownloader import IGDBDownloader
+from Metrics import metrics
 from XMLBuilder import XMLGenerator
 from redumpFiller import checkMissing
+from ROMVerifier import ROMVerifier
 
 
 def main():
@@ -19,26 +25,85 @@ def main():
 
     parser.add_argument("--download-dats", action="store_true", help="Download No-Intro DATs")
     parser.add_argument("--download-db", action="store_true", help="Download and generate the IGDB DB")
+    parser.add_argument("--full-db-refresh", action="store_true",
+                        help="Download the whole IGDB DB instead of the games updated since the last run")
+    parser.add_argument("--sequential-db", action="store_true",
+                        help="Download the IGDB DB one request at a time")
     parser.add_argument("--generate-xml", action="store_true", help="Generate the db.xml file")
+    parser.add_argument("--check-match-parity", action="store_true",
+                        help="Compare every indexed fuzzy match against a linear scan")
+    parser.add_argument("--batch-match", action="store_true",
+                        help="Fuzzy match all ROMs of a platform at once using every core")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore the fuzzy match cache of previous runs")
+    parser.add_argument("--previous-release", nargs=1, required=False,
+                        help="Release ZIP file to copy unchanged members from, the latest DB_*.zip by default")
+    parser.add_argument("--delta-package", action="store_true",
+                        help="Also generate an update package from the previous release to the new one")
+    parser.add_argument("--offline", action="store_true",
+                        help="Serve every download from the HTTP cache of previous runs")
     parser.add_argument("--update-custom-dat", nargs=1, required=False, help="Update the custom Sega CD DAT")
+    parser.add_argument("--process-covers", nargs=1, required=False,
+                        help="Convert the new or changed libretro-thumbnails covers of a folder to the MegaSD format")
+    parser.add_argument("--verify-roms", nargs=1, required=False,
+                        help="Check every ROM in a folder against the checksums of the latest DB")
+    parser.add_argument("--verify-db", nargs=1, required=False, help="DB ZIP file --verify-roms checks against")
+    parser.add_argument("--verify-report", nargs=1, required=False, default=['verify_roms.csv'],
+                        help="CSV report written by --verify-roms")
+    parser.add_argument("--profile", action="store_true",
+                        help="Write a cProfile dump and summary of every stage to the profiles folder")
 
     args = parser.parse_args()
 
     if len(sys.argv) == 1:
         parser.print_help()
 
+    http_cache.offline = args.offline
+    if args.profile:
+        metrics.profile_dir = 'profiles'
+
+    try:
+        run(args)
+
+        # Drop the HTTP responses that expired and weren't needed by this run
+        http_cache.prune()
+    finally:
+        # Next to the release ZIP file
+        if metrics.stages:
+            metrics.save(f'DB_{date.today()}_metrics.json')
+
+
+def run(args):
     if args.download_dats:
-        downloadDATs()
+        with metrics.stage('download_dats'):
+            downloadDATs()
 
     if args.update_custom_dat:
         print(args.update_custom_dat)
-        checkMissing(args.update_custom_dat[0])
+        with metrics.stage('update_custom_dat'):
+            checkMissing(args.update_custom_dat[0])
 
     if args.download_db:
-        IGDBDownloader()
+        with metrics.stage('download_db'):
+            if args.sequential_db:
+                IGDBDownloader(full_refresh=args.full_db_refresh)
+            else:
+                AsyncIGDBDownloader(full_refresh=args.full_db_refresh)
+
+    if args.process_covers:
+        with metrics.stage('process_covers'):
+            CoverProcessor(args.process_covers[0])
 
     if args.generate_xml:
-        XMLGenerator()
+        with metrics.stage('generate_xml'):
+            XMLGenerator(check_parity=args.check_match_parity, batch=args.batch_match,
+                         use_cache=not args.no_cache,
+                         previous_release=args.previous_release[0] if args.previous_release else None,
+                         delta_package=args.delta_package)
+
+    if args.verify_roms:
+        with metrics.stage('verify_roms'):
+            ROMVerifier(args.verify_roms[0], db_zip=args.verify_db[0] if args.verify_db else None,
+                        report=args.verify_report[0])
 
 
 if __name__ == "__main__":
@@ -2,13 +2,21 @@ import zipfile
 from xml.dom import minidom
 import zlib
 import os
+import re
+import unicodedata
 import time
 import httpx
 import asyncio
-from io import BytesIO
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from urllib.parse import quote
 from lxml import objectify, etree
+from ChunkedDownloader import ChunkedDownloader
+from CRCCache import CRCCache
 from datDownloader import downloadRedump
+from Metrics import metrics
+from RemoteFile import RemoteFile
 
 
 def _dat_to_dict(xml_path):
@@ -42,20 +50,26 @@ def checkMissing(game_source):
             del megasd_dict[name]
 
     # Add any new game from the Redump set in the MegaSD set
-    for name in redump_dict.keys():
-        if name not in megasd_dict.keys():
-            # the CRC from the dict is not valid for the MegaSD, so get the ROM from somewhere and generate the new CRC
-            print(f'Adding: {name[:-4]}')
-            # Attempt to download game OR open from a folder
-            if game_source.startswith('http'):
-                crc = asyncio.run(downloadRom(name[:-4], game_source))
-            else:
-                crc = crc_from_folder(name[:-4], game_source)
-            if crc is None:
-                print(f'{name[:-4]} NOT found')
-                continue
-            print(f'{name[:-4]} has CRC {crc}')
-            megasd_dict[name] = crc
+    # the CRC from the dict is not valid for the MegaSD, so get the ROM from somewhere and generate the new CRC
+    missing = [name for name in redump_dict.keys() if name not in megasd_dict.keys()]
+    print(f'Adding {len(missing)} games')
+
+    # CRCs calculated by previous runs, even unfinished ones
+    crc_cache = CRCCache('cache/crcs.json')
+
+    # Attempt to download games OR open from a folder
+    if game_source.startswith('http'):
+        crcs = asyncio.run(downloadRoms([name[:-4] for name in missing], game_source, crc_cache))
+    else:
+        crcs = crcs_from_folder([name[:-4] for name in missing], game_source, crc_cache)
+
+    for name in missing:
+        crc = crcs[name[:-4]]
+        if crc is None:
+            print(f'{name[:-4]} NOT found')
+            continue
+        print(f'{name[:-4]} has CRC {crc}')
+        megasd_dict[name] = crc
 
     # Re-add the games from the EXTRA DAT
     for name, crc in extras_dict.items():
@@ -77,90 +91,221 @@ def checkMissing(game_source):
         f.write(dat)
 
 
-async def download_chunk(url, start_byte, end_byte, zipdata, client):
+# Games downloaded at the same time, and limits shared by all of them
+GAMES = 8
+CONNECTIONS = 40
+BANDWIDTH = 50 * 1024 * 1024  # bytes per second
+
+
+class BandwidthLimiter():
+    """
+    Spaces out downloads so their total stays under a number of bytes per second
     """
-    Asynchronosuly download a single chunk
-    Thi ZIP chunk itself will be streamed in 4096 byte chunks
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = time.monotonic()
+
+    async def consume(self, size):
+        now = time.monotonic()
+        start = max(self.available, now)
+        self.available = start + size / self.rate
+        await asyncio.sleep(start - now)
+
+
+async def downloadRoms(names, base_url, crc_cache=None):
+    """
+    Calculate the CRCs of many games concurrently with a single connection pool
+
+    Returns game name -> CRC, or None if it wasn't found or failed
     """
-    start_time = time.time()
+    crcs = {}
+    failed = []
 
-    # Write to in-memory IO from start_byte to end_byte
-    # sart writing at start_byte
-    zipdata.seek(start_byte, 0)
+    limits = httpx.Limits(max_connections=CONNECTIONS, max_keepalive_connections=CONNECTIONS)
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as client:
+        bandwidth = BandwidthLimiter(BANDWIDTH)
+        games = asyncio.Semaphore(GAMES)
 
-    # Keep track of current byte
-    current = start_byte
-    headers = {
-        'Range': f'bytes={start_byte}-{end_byte}',
-        'Cache-Control': 'no-cache',
-        'Accept': '*/*',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Connection': 'keep-alive'
-    }
+        async def download(name):
+            async with games:
+                try:
+                    crcs[name] = await downloadRom(name, base_url, client, bandwidth, crc_cache)
+                except Exception as e:
+                    crcs[name] = None
+                    failed.append(name)
+                    print(f'{name} failed: {e!r}')
+            print(f'[{len(crcs)}/{len(names)}] {name}: {crcs[name] or "NOT found"}')
 
-    # Stream ZIP chunk in 4096 byte chunks
-    async with client.stream('GET', url, headers=headers, timeout=60.0) as resp:
-        resp.raise_for_status()
-        async for data in resp.aiter_bytes():
-            if data:
-                # write in the corrent place
-                zipdata.seek(current, 0)
-                zipdata.write(data)
-                # keep track of current byte
-                current += len(data)
+        await asyncio.gather(*[download(name) for name in names])
 
-    end_time = time.time()
-    print(f'{start_byte}-{end_byte} took {str(end_time-start_time)}')
+    print(f'{len([crc for crc in crcs.values() if crc is not None])} CRCs calculated, '
+          f'{len(failed)} games failed')
+    for name in failed:
+        print(f'Failed: {name}')
 
+    return crcs
 
-async def downloadRom(name, base_url):
+
+async def downloadRom(name, base_url, client=None, bandwidth=None, crc_cache=None):
     # Download game from a URL to generate the MegaSD hash
     # url from arguments
     url = f'{base_url}/{quote(name)}.zip'
 
-    client = httpx.AsyncClient()
+    if client is None:
+        async with httpx.AsyncClient() as client:
+            return await downloadRom(name, base_url, client, bandwidth, crc_cache)
 
     # HEAD request to check the content-length
-    r = await client.head(url, allow_redirects=True)
+    # Never cached, the ROM can be replaced under the same URL
+    metrics.count('http_requests')
+    r = await client.head(url, follow_redirects=True)
 
     # Game not found - abort
     if r.status_code != 200:
         return None
 
     length = int(r.headers['Content-Length'])
+    print(f'{name}: content length {length}')
 
-    # Divide game in X chunks and download concurrently
-    CONCURRENT = 40
-    chunk_size = (length / CONCURRENT) + (length % CONCURRENT)  #  TODO: last chunk will be smaller
-    print(f'Content length: {length}')
+    key = CRCCache.url_key(url, r.headers)
+    cached = crc_cache.get(key) if crc_cache is not None else None
+    if cached is not None:
+        print(f'{name}: CRC already calculated')
+        return cached
 
-    # Store all the needed requests to execute concurrently
-    urls = []
-    for i in range(CONCURRENT):
-        urls.append((url, int(chunk_size * i), int(chunk_size * (i + 1))))
+    crc = await calculateRemoteCRC(name, url, length, client, bandwidth)
+    if crc_cache is not None:
+        crc_cache.put(key, crc)
+    return crc
 
-    # Save ZIP data in memory
-    zipdata = BytesIO()
 
-    # Download all chunks concurrently
-    await asyncio.gather(*[download_chunk(d[0], d[1], d[2], zipdata, client) for d in urls])
+async def calculateRemoteCRC(name, url, length, client, bandwidth):
+    """
+    MegaSD CRC of a remote ZIP file, reading as little of it as possible
+    """
+    # The CRC only needs the cue sheet and the first 2KB of the first bin file,
+    # so read just the parts of the ZIP file that contain them
+    loop = asyncio.get_running_loop()
+
+    async def get(headers):
+        metrics.count('http_requests')
+        resp = await client.get(url, headers=headers, timeout=60.0, follow_redirects=True)
+        metrics.count('http_bytes_downloaded', len(resp.content))
+        if bandwidth is not None:
+            await bandwidth.consume(len(resp.content))
+        return resp
 
-    # calculate MegaSD CRC from the ZIP file
-    crc = cal_crc(zipdata)
-    print(f'CRC: {crc}')
-    return crc
+    try:
+        # cal_crc runs in a thread, its range requests still go through the shared client
+        remote = RemoteFile(url, length, lambda headers: asyncio.run_coroutine_threadsafe(get(headers), loop).result())
+        crc = await asyncio.to_thread(cal_crc, remote)
+        print(f'{name}: downloaded {remote.fetched} bytes in {remote.requests} requests')
+        return crc
+    except Exception as e:
+        print(f'{name}: partial download failed ({e}), downloading the whole ZIP file')
 
+    # Download it into a temporary file in concurrent ranges, cal_crc reads it from there
+    with tempfile.TemporaryFile() as f:
+        start_time = time.time()
+        await ChunkedDownloader(client, url, length, bandwidth).download(f)
+        print(f'{name}: downloaded {length} bytes in {time.time() - start_time:.1f}s')
 
-def crc_from_folder(name, source):
-    print(f'Attempting to open {source}/{name}.zip')
-    try:
-        with open(f'{source}/{name}.zip', 'rb') as f:
-            crc = cal_crc(f)
-            print(f'CRC: {crc}')
-            return crc
-    except FileNotFoundError:
-        print(f'{source}/{name}.zip not found')
-        pass
+        f.seek(0)
+        return await asyncio.to_thread(cal_crc, f)
+
+
+def _normalize_title(name):
+    """
+    Case, accent and punctuation insensitive game name, region and version tags are kept
+    """
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^0-9a-z]+', ' ', name.casefold()).split())
+
+
+def scan_library(source):
+    """
+    Index every game in a folder and all its subfolders, as ZIP files or loose cue/bin sets
+
+    Returns normalized name -> [(name, kind, path)]
+    """
+    index = defaultdict(list)
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for f in sorted(files):
+            name, ext = os.path.splitext(f)
+            if ext.lower() in ('.zip', '.cue'):
+                index[_normalize_title(name)].append((name, ext.lower()[1:], os.path.join(root, f)))
+    return index
+
+
+def find_in_library(index, name):
+    """
+    Library entry for a Redump name, one with the exact name if there are several
+    """
+    entries = index.get(_normalize_title(name), [])
+    for entry in entries:
+        if entry[0] == name:
+            return entry
+    return entries[0] if entries else None
+
+
+def library_crc(kind, path):
+    """
+    MegaSD CRC of a library entry, runs in a worker process
+    """
+    if kind == 'zip':
+        with open(path, 'rb') as f:
+            return cal_crc(f)
+
+    with open(path, 'rb') as f:
+        return cue_crc(f, lambda bin_file: open(os.path.join(os.path.dirname(path), bin_file), 'rb'))
+
+
+def crcs_from_folder(names, source, crc_cache=None):
+    """
+    Find many games in a local folder and calculate their CRCs in parallel
+
+    Returns game name -> CRC, or None if it wasn't found or failed
+    """
+    index = scan_library(source)
+    print(f'Indexed {sum(len(entries) for entries in index.values())} games in {source}')
+
+    crcs = {}
+    pending = {}
+    for name in names:
+        entry = find_in_library(index, name)
+        if entry is None:
+            print(f'{name} not found in {source}')
+            crcs[name] = None
+            continue
+
+        key = CRCCache.file_key(entry[2])
+        cached = crc_cache.get(key) if crc_cache is not None else None
+        if cached is not None:
+            print(f'{name}: CRC (cached) {cached}')
+            crcs[name] = cached
+            continue
+
+        pending[name] = (entry, key)
+
+    with ProcessPoolExecutor() as executor:
+        futures = {name: executor.submit(library_crc, entry[1], entry[2]) for name, (entry, key) in pending.items()}
+        for i, (name, future) in enumerate(futures.items()):
+            entry, key = pending[name]
+            try:
+                crcs[name] = future.result()
+            except Exception as e:
+                print(f'{name} failed: {e!r}')
+                crcs[name] = None
+                continue
+
+            print(f'[{i + 1}/{len(futures)}] {entry[2]}: {crcs[name]}')
+            if crc_cache is not None:
+                crc_cache.put(key, crcs[name])
+
+    return crcs
 
 
 def cal_crc(file_io):
@@ -170,20 +315,25 @@ def cal_crc(file_io):
     for a in archive.namelist():
         file_without_ext, ext = os.path.splitext(a)
         if ext == '.cue':
-            cueFile = archive.open(a)
-            # Get first bin file from first or second cue sheet line
-            for i, line in enumerate(cueFile):
-                line = line.decode('unicode_escape')
-                if 'CATALOG' in line:
-                    continue
-                else:
-                    bin_file = line[6:-10]
-                    break
-
-            # Read first 2KB of first bin file of CUE sheet
-            binFile = archive.open(bin_file)
-            prev = 0
-            binFile.read(16)
-            b = binFile.read(2048)
-            prev = zlib.crc32(b, prev)
-            return "%X" % (prev & 0xFFFFFFFF)
+            return cue_crc(archive.open(a), archive.open)
+
+
+def cue_crc(cueFile, open_file):
+    """Calculate MegaSD CRC value from a cue sheet, open_file opens the bin files it names"""
+    # Get first bin file from first or second cue sheet line
+    for i, line in enumerate(cueFile):
+        line = line.decode('unicode_escape')
+        if 'CATALOG' in line:
+            continue
+        else:
+            # FILE "name.bin" BINARY
+            bin_file = line.rstrip('\r\n')[6:-8]
+            break
+
+    # Read first 2KB of first bin file of CUE sheet
+    with open_file(bin_file) as binFile:
+        prev = 0
+        binFile.read(16)
+        b = binFile.read(2048)
+        prev = zlib.crc32(b, prev)
+        return "%X" % (prev & 0xFFFFFFFF)